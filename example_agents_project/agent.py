@@ -1,21 +1,20 @@
 import os
-from typing import Literal
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Literal
 
 from langchain_core.messages import HumanMessage
 from langgraph.graph import END, START, StateGraph, MessagesState
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
-from langgraph.prebuilt import ToolNode
-from langchain_openai import ChatOpenAI
-from langchain_google_community import GmailToolkit
-from langchain_google_community.gmail.utils import (
-    build_resource_service,
-)
-from psycopg import AsyncConnection
 from psycopg.rows import dict_row
-from functools import wraps
+from psycopg_pool import AsyncConnectionPool
 
-from .credentials import get_user_credentials
+from .credentials import get_valid_user_token, to_credentials
 from .cache import acquire_lock, release_lock
+from .db import NoCredentialsFound
+
+if TYPE_CHECKING:
+    from langchain_core.tools import BaseTool
+    from langgraph.graph.state import CompiledStateGraph
 
 DB_HOST = os.getenv("DB_HOST")
 DB_NAME = os.getenv("DB_NAME")
@@ -26,21 +25,48 @@ DB_URI = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
 MODEL = "gpt-4o"
 
 
-workflows: dict[str, StateGraph] = {}
+compiled_apps: dict[str, "CompiledStateGraph"] = {}
+# user_id -> (tools, the access token they were built with)
+tools_cache: dict[str, tuple[list["BaseTool"], str]] = {}
+
+_pool: AsyncConnectionPool = None
+_checkpointer: AsyncPostgresSaver = None
+
 
+async def init_checkpointer():
+    """Opens the checkpointer connection pool and sets up its tables (once)."""
+    global _pool, _checkpointer
+    _pool = AsyncConnectionPool(
+        DB_URI,
+        min_size=2,
+        max_size=10,
+        kwargs={
+            "autocommit": True,
+            "prepare_threshold": 0,
+            "row_factory": dict_row,
+        },
+        open=False,
+    )
+    await _pool.open()
+
+    _checkpointer = AsyncPostgresSaver(_pool)
+    await _checkpointer.setup()
 
-def lock_required(func):
-    @wraps(func)
-    async def wrapper(user_id: str, *args, **kwargs):
-        lock = await acquire_lock(user_id)
-        if not lock:
-            raise FailedToAcquireSessionLockException()
-        try:
-            return await func(user_id, *args, **kwargs)
-        finally:
-            await release_lock(user_id)
 
-    return wrapper
+async def close_checkpointer():
+    await _pool.close()
+
+
+@asynccontextmanager
+async def user_lock(user_id: str):
+    """Serializes graph runs per user, since they share a checkpoint thread."""
+    token = await acquire_lock(user_id)
+    if not token:
+        raise FailedToAcquireSessionLockException()
+    try:
+        yield
+    finally:
+        await release_lock(user_id, token)
 
 
 class FailedToAcquireSessionLockException(Exception):
@@ -57,17 +83,45 @@ def should_continue(state: MessagesState) -> Literal["tools", END]:
     return END
 
 
-async def get_tools(user_id):
-    credentials = await get_user_credentials(user_id)
-    api_resource = build_resource_service(credentials=credentials)
+def evict_user(user_id: str):
+    """Drops the user's cached graph and tools (e.g. on revoking credentials)."""
+    compiled_apps.pop(user_id, None)
+    tools_cache.pop(user_id, None)
+
+
+def _tools_stale(user_id: str, access_token: str) -> bool:
+    # Tools are rebuilt once the user's access token changes (refresh, or a
+    # revoke and re-auth, possibly handled by another worker)
+    try:
+        _, built_with = tools_cache[user_id]
+    except KeyError:
+        return True
+    return built_with != access_token
+
+
+async def get_tools(user_id: str, creds: dict):
+    if not _tools_stale(user_id, creds["access_token"]):
+        tools, _ = tools_cache[user_id]
+        return tools
+
+    # Deferred: the Gmail toolkit is slow to import and only chat needs it
+    from langchain_google_community import GmailToolkit
+    from langchain_google_community.gmail.utils import build_resource_service
+
+    api_resource = build_resource_service(credentials=to_credentials(creds))
 
     toolkit = GmailToolkit(api_resource=api_resource)
     tools = toolkit.get_tools()
+    tools_cache[user_id] = (tools, creds["access_token"])
     return tools
 
 
-async def get_workflow(user_id: str):
-    tools = await get_tools(user_id)
+async def get_workflow(user_id: str, creds: dict):
+    # Deferred: the model client and prebuilt nodes are slow to import
+    from langchain_openai import ChatOpenAI
+    from langgraph.prebuilt import ToolNode
+
+    tools = await get_tools(user_id, creds)
     tool_node = ToolNode(tools)
 
     model = ChatOpenAI(model=MODEL, temperature=0).bind_tools(tools)
@@ -91,33 +145,30 @@ async def get_workflow(user_id: str):
     return workflow
 
 
-@lock_required
-async def process_message(user_id: str, message: str):
-    if not user_id or not message:
-        return {"error": "Missing required fields: user_id or message"}
+async def process_message(user_id: str, message: str) -> str:
+    """Runs the user's message through their graph and returns the reply.
 
-    try:
-        workflow = workflows[user_id]
-    except KeyError:
-        workflow = await get_workflow(user_id)
-        workflows[user_id] = workflow
-
-    connection_kwargs = {
-        "autocommit": True,
-        "prepare_threshold": 0,
-        "row_factory": dict_row,
-    }
-    async with await AsyncConnection.connect(DB_URI, **connection_kwargs) as conn:
-        checkpointer = AsyncPostgresSaver(conn)
+    Raises NoCredentialsFound if the user's tokens are gone (e.g. revoked).
+    """
+    if not user_id or not message:
+        return "Missing required fields: user_id or message"
 
-        # Initialize the database (run this once)
-        await checkpointer.setup()
+    # Served from the local/Redis cache on the hot path
+    creds = await get_valid_user_token(user_id)
+    if creds is None:
+        raise NoCredentialsFound("Tokens not found")
 
-        app = workflow.compile(checkpointer=checkpointer)
+    app = compiled_apps.get(user_id)
+    if app is None or _tools_stale(user_id, creds["access_token"]):
+        workflow = await get_workflow(user_id, creds)
+        app = workflow.compile(checkpointer=_checkpointer)
+        compiled_apps[user_id] = app
 
-        config = {"configurable": {"thread_id": user_id}}
-        inputs = {"messages": [HumanMessage(content=message)]}
+    config = {"configurable": {"thread_id": user_id}}
+    inputs = {"messages": [HumanMessage(content=message)]}
 
+    # Only the graph run mutates the user's checkpointed state
+    async with user_lock(user_id):
         result = await app.ainvoke(inputs, config=config)
 
     return result["messages"][-1].content
@@ -1,26 +1,68 @@
+import asyncio
 import logging
 import os
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
-
-from . import cache
-from .agent import process_message
+from typing import Final
+
+from . import cache, http
+from .agent import (
+    init_checkpointer,
+    close_checkpointer,
+    evict_user,
+    process_message,
+)
 from .credentials import (
     get_access_token,
     store_user_credentials,
     get_user_credentials,
     get_auth_url,
-    has_user_credentials,
+    resolve_auth,
     revoke_credentials,
 )
-from .db import init_db
-from .slack import send_slack_message
+from .db import NoCredentialsFound, init_db, close_db
+from .middleware import CORSMiddleware, SlackEventsMiddleware
+from .slack import prebuild_message, send_slack_message
 
 load_dotenv()
 
+# Canned Slack replies; their blocks are serialized once at import time
+HELLO_MESSAGE: Final[str] = prebuild_message(
+    "Hello! I'm here to help!\n"
+    "First you need to authenticate (message: `auth`).\n"
+    "You can check your authentication status (message: `status`).\n"
+    "Then I can help manage your emails (read; send; draft) (message: `chat`).\n"
+    "Finally, you can revoke credentials (message: `revoke`).\n"
+)
+AUTH_SUCCESS_MESSAGE: Final[str] = prebuild_message(
+    "Success! You have authenticated with Google. You can use the `chat` now."
+)
+AUTH_EXISTS_MESSAGE: Final[str] = prebuild_message(
+    "You have existing credentials.\nYou can use `chat`; or else `revoke` first."
+)
+STATUS_AUTHED_MESSAGE: Final[str] = prebuild_message(
+    "You have existing credentials.\nYou can use `chat` to send messages."
+)
+STATUS_NO_AUTH_MESSAGE: Final[str] = prebuild_message(
+    "You don't have existing credentials.\nUse `auth` to authenticate."
+)
+REVOKED_MESSAGE: Final[str] = prebuild_message("Credentials revoked successfully.")
+REVOKE_NO_AUTH_MESSAGE: Final[str] = prebuild_message(
+    "You don't have existing credentials. Use `auth` to authenticate."
+)
+CHAT_NO_AUTH_MESSAGE: Final[str] = prebuild_message(
+    "You are not authenticated with Google. Please use `auth` first."
+)
+CHAT_STARTED_MESSAGE: Final[str] = prebuild_message(
+    "Chat session started. Please provide instructions; "
+    "use `chat: <message>` for chat messages."
+)
+FALLBACK_MESSAGE: Final[str] = prebuild_message(
+    "Sorry, I didn't understand that. Try message: `hello`, `auth`, `chat`, `revoke`."
+)
+
 
 class HostnameFormatter(logging.Formatter):
     """Custom formatter to add Docker hostname to log messages."""
@@ -40,20 +82,54 @@ logging.getLogger().handlers[0].setFormatter(
 )
 
 
+async def init_postgres():
+    # The checkpointer needs the database that init_db creates
+    await init_db()
+    _logger.info("Database initialized successfully")
+
+    await init_checkpointer()
+    _logger.info("Checkpointer initialized successfully")
+
+
+async def init_redis():
+    await cache.init_client()
+    cache.start_invalidation_listener()
+    _logger.info("Redis client initialized successfully")
+
+
+async def init_http():
+    await http.init_client()
+    _logger.info("HTTP client initialized successfully")
+
+
+async def close_postgres():
+    await close_checkpointer()
+    _logger.info("Checkpointer closed successfully")
+
+    await close_db()
+    _logger.info("Database pool closed successfully")
+
+
+async def close_redis():
+    await cache.close_client()
+    _logger.info("Redis client closed successfully")
+
+
+async def close_http():
+    await http.close_client()
+    _logger.info("HTTP client closed successfully")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     _logger.info("Starting lifespan")
     try:
-        await init_db()
-        _logger.info("Database initialized successfully")
-
-        await cache.init_client()
-        _logger.info("Redis client initialized successfully")
+        # Postgres, Redis and the HTTP client are independent of each other
+        await asyncio.gather(init_postgres(), init_redis(), init_http())
 
         yield
 
-        await cache.close_client()
-        _logger.info("Redis client closed successfully")
+        await asyncio.gather(close_http(), close_redis(), close_postgres())
     except Exception as e:
         _logger.error(f"Error during lifespan startup: {e}")
         raise
@@ -61,7 +137,10 @@ async def lifespan(app: FastAPI):
         _logger.info("Closing lifespan")
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Answer Slack acks (verification, duplicates, non-messages) before routing
+app.add_middleware(SlackEventsMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -86,8 +165,10 @@ async def auth_callback(request: Request, background_tasks: BackgroundTasks):
     _logger.info("Auth callback endpoint called")
 
     code = request.query_params.get("code")
-    user_id, channel, thread_ts = request.query_params.get("state").split(",")
-    thread_ts = None if thread_ts == "None" else thread_ts
+    # State is "user|channel|thread_ts", with an empty thread_ts outside threads
+    user_id, _, rest = request.query_params.get("state", "").partition("|")
+    channel, _, thread_ts = rest.partition("|")
+    thread_ts = thread_ts or None
 
     _logger.info(f"User ID: {user_id}, Channel: {channel}, Thread TS: {thread_ts}")
 
@@ -98,37 +179,100 @@ async def auth_callback(request: Request, background_tasks: BackgroundTasks):
         )
 
     data = await get_access_token(code)
-    await store_user_credentials(user_id, data)
-    await cache.set_user_token(user_id, data)  # update cache
+    tokens = await store_user_credentials(user_id, data)
+    await cache.set_user_token(user_id, tokens)  # update cache
 
-    message = "Success! You have authenticated with Google. You can use the `chat` now."
-    background_tasks.add_task(send_slack_message, message, channel, thread_ts)
+    background_tasks.add_task(
+        send_slack_message, AUTH_SUCCESS_MESSAGE, channel, thread_ts
+    )
 
     _logger.info("User %s successfully authenticated", user_id)
 
-    return JSONResponse(
+    return ORJSONResponse(
         content={
             "message": "Authentication successful. You can close this tab and return to Slack."
         }
     )
 
 
-@app.post("/slack/events")
-async def slack_events(slack_event: dict, background_tasks: BackgroundTasks):
-    """Endpoint to handle Slack events."""
-    event_type = slack_event.get("type")
-    event_id = slack_event.get("event_id")
+def parse_command(text: str | None) -> str:
+    """Returns the lowercased first word of a message, e.g. `chat` in `Chat: hi`."""
+    head, _, _ = (text or "").partition(":")
+    words = head.split(None, 1)
+    return words[0].rstrip("!?.,").lower() if words else ""
+
+
+async def handle_hello(user_id: str, channel: str, thread_ts: str, text: str) -> str:
+    return HELLO_MESSAGE
+
+
+async def handle_auth(user_id: str, channel: str, thread_ts: str, text: str) -> str:
+    if await resolve_auth(user_id):
+        return AUTH_EXISTS_MESSAGE
+
+    auth_url = get_auth_url(user_id, channel, thread_ts)
+    return f"Please click <{auth_url}|here> to authenticate with Google."
+
+
+async def handle_status(user_id: str, channel: str, thread_ts: str, text: str) -> str:
+    if await resolve_auth(user_id):
+        return STATUS_AUTHED_MESSAGE
+    return STATUS_NO_AUTH_MESSAGE
+
+
+async def handle_revoke(user_id: str, channel: str, thread_ts: str, text: str) -> str:
+    # Fetches the tokens once and clears the DB and cache; False if none
+    if not await revoke_credentials(user_id):
+        return REVOKE_NO_AUTH_MESSAGE
+
+    evict_user(user_id)
+    return REVOKED_MESSAGE
+
 
-    if event_type == "url_verification":
-        _logger.info("URL verification challenge received")
-        return {"challenge": slack_event.get("challenge")}
+async def handle_chat(user_id: str, channel: str, thread_ts: str, text: str) -> str:
+    if not await get_user_credentials(user_id):
+        return CHAT_NO_AUTH_MESSAGE
 
-    # Prevent duplicate events (Slack funkiness)
-    if await cache.exists_event_id(event_id):
-        _logger.info("Event %s already processed", event_id)
-        return {"status": "ok"}
-    else:
-        await cache.add_event_id(event_id)  # add to cache
+    _, _, chat_message = text.partition(":")
+    chat_message = chat_message.lstrip()
+    if not chat_message:
+        return CHAT_STARTED_MESSAGE
+
+    try:
+        return await process_message(user_id, chat_message)
+    except NoCredentialsFound:
+        # Revoked since the check above
+        return CHAT_NO_AUTH_MESSAGE
+
+
+async def handle_unknown(user_id: str, channel: str, thread_ts: str, text: str) -> str:
+    return FALLBACK_MESSAGE
+
+
+COMMANDS = {
+    "hello": handle_hello,
+    "auth": handle_auth,
+    "status": handle_status,
+    "revoke": handle_revoke,
+    "chat": handle_chat,
+}
+
+
+@app.post("/slack/events")
+async def slack_events(request: Request, background_tasks: BackgroundTasks):
+    """Endpoint to handle Slack events.
+
+    Verification, duplicate and non-message events are already answered by
+    SlackEventsMiddleware, which also hands over the parsed event.
+    """
+    slack_event = getattr(request.state, "slack_event", None)
+    if slack_event is None:
+        # The middleware only skips bodies that aren't a JSON object
+        raise HTTPException(
+            status_code=422, detail="Request body must be a JSON object"
+        )
+
+    event_id = slack_event.get("event_id")
 
     _logger.info(f"Handling Slack event: {event_id}")
 
@@ -140,90 +284,14 @@ async def slack_events(slack_event: dict, background_tasks: BackgroundTasks):
     ):
         user_id = event_data.get("user")
         channel = event_data.get("channel")
-        thread_ts = event_data.get("thread_ts")
+        thread_ts = event_data.get("thread_ts") or None
         text = event_data.get("text")
 
-        # No thread (Slack funkiness)
-        thread_ts = None if thread_ts == "None|here" else thread_ts
-
         _logger.info(f"Received message event from user {user_id}: {text}")
 
-        if text and text.lower().startswith("hello"):
-            response_text = (
-                "Hello! I'm here to help!\n"
-                "First you need to authenticate (message: `auth`).\n"
-                "You can check your authentication status (message: `status`).\n"
-                "Then I can help manage your emails (read; send; draft) (message: `chat`).\n"
-                "Finally, you can revoke credentials (message: `revoke`).\n"
-            )
-            background_tasks.add_task(
-                send_slack_message, response_text, channel, thread_ts
-            )
-        elif text and text.lower().startswith("auth"):
-            # Check if user has existing credentials - prioritise cache over db
-            if await cache.exists_user_token(user_id) or await has_user_credentials(
-                user_id
-            ):
-                message = """You have existing credentials.\nYou can use `chat`; or else `revoke` first."""
-            else:
-                auth_url = get_auth_url(user_id, channel, thread_ts)
-                message = f"Please click <{auth_url}|here> to authenticate with Google."
-
-            background_tasks.add_task(send_slack_message, message, channel, thread_ts)
-
-        elif text and text.lower().startswith("status"):
-            # Check if user has existing credentials - prioritise cache over db
-            if await cache.exists_user_token(user_id) or await has_user_credentials(
-                user_id
-            ):
-                message = """You have existing credentials.\nYou can use `chat` to send messages."""
-            else:
-                message = """You don't have existing credentials.\nUse `auth` to authenticate."""
-
-            background_tasks.add_task(send_slack_message, message, channel, thread_ts)
-
-        elif text and text.lower().startswith("revoke"):
-            has_creds = await has_user_credentials(user_id)
-            _logger.info(f"Has creds: {has_creds}")
-
-            if has_creds:
-                await revoke_credentials(user_id)
-                await cache.remove_user_token(user_id)  # delete from cache
-                message = "Credentials revoked successfully."
-            else:
-                message = (
-                    "You don't have existing credentials. Use `auth` to authenticate."
-                )
-
-            background_tasks.add_task(send_slack_message, message, channel, thread_ts)
-
-        elif text and text.lower().startswith("chat"):
-            if not await get_user_credentials(user_id):
-                response_text = (
-                    "You are not authenticated with Google. Please use `auth` first."
-                )
-            else:
-                chat_message = None
-                if ":" in text:
-                    _, chat_message = text.split(":", maxsplit=1)
-                    chat_message = chat_message.lstrip()
-
-                if not chat_message:
-                    response_text = "Chat session started. Please provide instructions; use `chat: <message>` for chat messages."
-                else:
-                    response_text = await process_message(user_id, chat_message)
-
-            background_tasks.add_task(
-                send_slack_message, response_text, channel, thread_ts
-            )
-
-        else:
-            background_tasks.add_task(
-                send_slack_message,
-                "Sorry, I didn't understand that. Try message: `hello`, `auth`, `chat`, `revoke`.",
-                channel,
-                thread_ts,
-            )
+        handler = COMMANDS.get(parse_command(text), handle_unknown)
+        message = await handler(user_id, channel, thread_ts, text)
+        background_tasks.add_task(send_slack_message, message, channel, thread_ts)
 
     _logger.info(f"Event {event_id} processed successfully")
 
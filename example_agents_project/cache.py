@@ -1,82 +1,384 @@
+import asyncio
+import contextlib
+import logging
 import os
+import secrets
+from collections import OrderedDict
+from datetime import datetime
+import orjson
 from dotenv import load_dotenv
-from redis.asyncio import Redis
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.client import Pipeline
+from redis.commands.core import AsyncScript
 import time
-import asyncio
+from uuid import uuid4
 
 load_dotenv()
 
+_logger = logging.getLogger(__name__)
+
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+
+EVENT_TTL_SECS = 3600
+AUTH_TTL_SECS = 3600
+NO_AUTH_TTL_SECS = 60  # short-lived, so a new `auth` is picked up quickly
+LOCK_TTL_SECS = 3600
+
+# In-process L1 in front of Redis for user token/auth state lookups
+LOCAL_TTL_SECS = 30
+LOCAL_MAX_ENTRIES = 10_000
+INVALIDATION_CHANNEL = "invalidations"
+# Tags this process's invalidations; Redis also delivers them to the publisher
+PROCESS_ID = uuid4().hex
+
+# Only the holder (matching token) may delete the lock; then wake one waiter
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('LPUSH', KEYS[2], 1)
+    redis.call('EXPIRE', KEYS[2], 1)
+    return 1
+end
+return 0
+"""
+
+# Caches the tokens (if still valid) and auth state, then tells other workers
+SET_USER_TOKEN_SCRIPT = """
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[3])
+redis.call('PUBLISH', ARGV[4], ARGV[5])
+return 1
+"""
 
 _redis_client: Redis = None
+_release_lock_script: AsyncScript = None
+_set_user_token_script: AsyncScript = None
+_invalidation_listener: asyncio.Task = None
+
+# key -> (monotonic expiry, value); ordered oldest-used first
+_local_cache: OrderedDict[str, tuple[float, object]] = OrderedDict()
+
+# event_id -> monotonic expiry, for events known to be in Redis. Event ids
+# are never rewritten, so a local hit is always a duplicate; a miss still
+# has to ask Redis, since another worker may have claimed the event.
+_local_events: OrderedDict[str, float] = OrderedDict()
+
+
+def _local_get(key: str):
+    """Returns the unexpired local value for key, or None."""
+    entry = _local_cache.get(key)
+    if entry is None:
+        return None
+
+    expires_at, value = entry
+    if expires_at <= time.monotonic():
+        del _local_cache[key]
+        return None
+
+    _local_cache.move_to_end(key)
+    return value
+
+
+def _local_set(key: str, value, ttl: float = LOCAL_TTL_SECS):
+    _local_cache[key] = (time.monotonic() + min(ttl, LOCAL_TTL_SECS), value)
+    _local_cache.move_to_end(key)
+    if len(_local_cache) > LOCAL_MAX_ENTRIES:
+        _local_cache.popitem(last=False)
+
+
+def _local_drop_user(user_id: str):
+    _local_cache.pop(f"user:{user_id}", None)
+    _local_cache.pop(f"auth:{user_id}", None)
+
+
+def _local_has_event(event_id: str) -> bool:
+    expires_at = _local_events.get(event_id)
+    if expires_at is None:
+        return False
+
+    if expires_at <= time.monotonic():
+        del _local_events[event_id]
+        return False
+    return True
+
+
+def _local_add_event(event_id: str):
+    _local_events[event_id] = time.monotonic() + EVENT_TTL_SECS
+    _local_events.move_to_end(event_id)
+    if len(_local_events) > LOCAL_MAX_ENTRIES:
+        _local_events.popitem(last=False)
+
+
+def _invalidation_message(user_id: str) -> str:
+    return f"{PROCESS_ID}:{user_id}"
+
+
+def _invalidate_user(pipe: Pipeline, user_id: str):
+    """Drops the user's local entries here and, via pub/sub, on other workers."""
+    _local_drop_user(user_id)
+    pipe.publish(INVALIDATION_CHANNEL, _invalidation_message(user_id))
+
+
+def _handle_invalidation(data: bytes):
+    origin, _, user_id = data.decode().partition(":")
+    # Our own writes already updated the local cache; keep those entries
+    if origin != PROCESS_ID:
+        _local_drop_user(user_id)
 
 
 async def init_client():
-    global _redis_client
-    _redis_client = Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+    global _redis_client, _release_lock_script, _set_user_token_script
+    # Callers wait (up to `timeout`) for a free connection instead of erroring
+    pool = BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=0,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=5,
+        health_check_interval=30,
+    )
+    _redis_client = Redis(connection_pool=pool)
     await _redis_client.initialize()
+    _release_lock_script = _redis_client.register_script(RELEASE_LOCK_SCRIPT)
+    _set_user_token_script = _redis_client.register_script(SET_USER_TOKEN_SCRIPT)
+    _local_cache.clear()
+    _local_events.clear()
+
+
+async def _listen_for_invalidations():
+    while True:
+        try:
+            async with _redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        _handle_invalidation(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _logger.error(f"Invalidation listener failed: {e}")
+
+        # Invalidations may have been missed while disconnected
+        _local_cache.clear()
+        await asyncio.sleep(1)
+
+
+def start_invalidation_listener():
+    """Keeps the local cache coherent with writes made by other workers."""
+    global _invalidation_listener
+    _invalidation_listener = asyncio.create_task(_listen_for_invalidations())
 
 
 def get_client() -> Redis:
     return _redis_client
 
 
+def pipeline() -> Pipeline:
+    """Batches queued commands into one round trip on `await pipe.execute()`."""
+    return _redis_client.pipeline(transaction=False)
+
+
 async def close_client():
+    global _invalidation_listener
+    if _invalidation_listener is not None:
+        # Let the listener unwind its pubsub connection before the pool closes
+        _invalidation_listener.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _invalidation_listener
+        _invalidation_listener = None
     await _redis_client.close()
     await _redis_client.connection_pool.disconnect()
 
 
 async def add_event_id(event_id: str):
     """Add event_id to cache with a 1-hour TTL."""
-    client = get_client()
-    await client.set(f"event:{event_id}", event_id, ex=3600)
+    await _redis_client.set(f"event:{event_id}", event_id, ex=EVENT_TTL_SECS)
+    _local_add_event(event_id)
 
 
 async def exists_event_id(event_id: str) -> bool:
     """Check if event_id exists in cache."""
-    client = get_client()
-    event_id = await client.get(f"event:{event_id}")
-    return True if event_id is not None else False
+    if _local_has_event(event_id):
+        return True
+
+    exists = await _redis_client.exists(f"event:{event_id}")
+    if exists != 1:
+        return False
+
+    _local_add_event(event_id)
+    return True
+
+
+async def claim_event_id(event_id: str) -> bool:
+    """Atomically add event_id to cache (1-hour TTL); False if already present."""
+    if _local_has_event(event_id):
+        return False
+
+    claimed = await _redis_client.set(
+        f"event:{event_id}", 1, ex=EVENT_TTL_SECS, nx=True
+    )
+    # Either way the event is now in Redis, so retries stay local
+    _local_add_event(event_id)
+    return True if claimed else False
 
 
 async def delete_event_id(event_id: str):
-    """Delete event_id from cache."""
-    client = get_client()
-    await client.delete(f"event:{event_id}")
+    """Delete event_id from cache (other workers may still see it locally)."""
+    _local_events.pop(event_id, None)
+    await _redis_client.delete(f"event:{event_id}")
 
 
 async def exists_user_token(user_id: str) -> bool:
-    """Check if user_id exists in cache."""
-    client = get_client()
-    exists = await client.sismember("tokens", user_id)
+    """Check if user tokens exist in cache."""
+    exists = await _redis_client.exists(f"user:{user_id}")
     return True if exists == 1 else False
 
 
+async def exists_user_tokens(user_ids: list[str]) -> list[bool]:
+    """Check which of user_ids have tokens in cache, in one round trip."""
+    async with pipeline() as pipe:
+        for user_id in user_ids:
+            pipe.exists(f"user:{user_id}")
+        results = await pipe.execute()
+    return [exists == 1 for exists in results]
+
+
 async def set_user_token(user_id: str, tokens: dict):
-    """Set user tokens in Redis."""
-    client = get_client()
-    await client.sadd("tokens", user_id)
+    """Set user tokens in Redis; they expire with the access token.
+
+    Runs as one script, so the token and auth state are written atomically.
+    """
+    ttl = int((tokens["expires_at"] - datetime.now()).total_seconds())
+    await _set_user_token_script(
+        keys=[f"user:{user_id}", f"auth:{user_id}"],
+        args=[
+            orjson.dumps(tokens),
+            ttl,
+            AUTH_TTL_SECS,
+            INVALIDATION_CHANNEL,
+            _invalidation_message(user_id),
+        ],
+    )
+
+    _local_drop_user(user_id)
+
+    if ttl > 0:
+        _local_set(f"user:{user_id}", tokens, ttl)
+    _local_set(f"auth:{user_id}", True)
+
+
+async def fill_user_token(user_id: str, tokens: dict):
+    """Cache tokens just read from the DB.
+
+    Nothing changed, so unlike set_user_token other workers aren't invalidated.
+    Only fills missing keys (NX), so a fill racing a real write can't undo it.
+    """
+    ttl = int((tokens["expires_at"] - datetime.now()).total_seconds())
+    if ttl <= 0:
+        return
+
+    async with pipeline() as pipe:
+        pipe.set(f"user:{user_id}", orjson.dumps(tokens), ex=ttl, nx=True)
+        pipe.set(f"auth:{user_id}", 1, ex=AUTH_TTL_SECS, nx=True)
+        user_set, auth_set = await pipe.execute()
+
+    if user_set:
+        _local_set(f"user:{user_id}", tokens, ttl)
+    if auth_set:
+        _local_set(f"auth:{user_id}", True)
+
+
+async def get_user_token(user_id: str) -> dict | None:
+    """Get user tokens from the local cache, else Redis (None if not cached)."""
+    tokens = _local_get(f"user:{user_id}")
+    if tokens is not None:
+        return tokens
+
+    value = await _redis_client.get(f"user:{user_id}")
+    if value is None:
+        return None
+
+    tokens = orjson.loads(value)
+    tokens["expires_at"] = datetime.fromisoformat(tokens["expires_at"])
+    ttl = (tokens["expires_at"] - datetime.now()).total_seconds()
+    _local_set(f"user:{user_id}", tokens, ttl)
+    return tokens
 
 
 async def remove_user_token(user_id: str):
     """Delete user tokens from Redis."""
-    client = get_client()
-    await client.srem("tokens", user_id)
+    async with pipeline() as pipe:
+        pipe.delete(f"user:{user_id}", f"auth:{user_id}")
+        _invalidate_user(pipe, user_id)
+        await pipe.execute()
+
+
+async def get_user_auth_state(user_id: str) -> bool | None:
+    """Get the cached auth state for user_id (None if not cached)."""
+    state = _local_get(f"auth:{user_id}")
+    if state is not None:
+        return state
+
+    state = await _redis_client.get(f"auth:{user_id}")
+    if state is None:
+        return None
+
+    has_auth = bool(int(state))
+    _local_set(f"auth:{user_id}", has_auth)
+    return has_auth
+
+
+async def fill_user_auth_state(user_id: str, has_auth: bool):
+    """Cache an auth state just read from the DB; negative states expire quickly.
+
+    Like fill_user_token: no invalidation, and only fills a missing key (NX).
+    """
+    ttl = AUTH_TTL_SECS if has_auth else NO_AUTH_TTL_SECS
+    if await _redis_client.set(f"auth:{user_id}", int(has_auth), ex=ttl, nx=True):
+        _local_set(f"auth:{user_id}", has_auth)
+
+
+async def set_user_auth_state(user_id: str, has_auth: bool):
+    """Cache a changed auth state for user_id, invalidating other workers."""
+    async with pipeline() as pipe:
+        if has_auth:
+            pipe.set(f"auth:{user_id}", 1, ex=AUTH_TTL_SECS)
+        else:
+            pipe.set(f"auth:{user_id}", 0, ex=NO_AUTH_TTL_SECS)
+        _invalidate_user(pipe, user_id)
+        await pipe.execute()
+
+    _local_set(f"auth:{user_id}", has_auth)
+
+
+async def acquire_lock(user_id: str, timeout_secs: int = 10) -> str | None:
+    """Attempt to acquire the lock for a specific user_id within a timeout period.
+
+    Returns the holder's token (needed to release the lock), or None on timeout.
+    """
+    token = secrets.token_hex(8)
+    end_time = time.monotonic() + timeout_secs
+    while True:
+        acquired = await _redis_client.set(
+            f"lock:{user_id}", token, ex=LOCK_TTL_SECS, nx=True
+        )
+        if acquired:
+            return token
 
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            return None
 
-async def acquire_lock(user_id: str, timeout_secs: int = 10) -> bool:
-    """Attempt to acquire the lock for a specific user_id within a timeout period."""
-    client = get_client()
-    end_time = time.time() + timeout_secs
-    while time.time() < end_time:
-        if await client.set(f"lock:{user_id}", "true", ex=3600, nx=True):
-            return True
-        await asyncio.sleep(0.1)
-    return False
+        # Block until the holder signals release (or timeout), then retry
+        await _redis_client.blpop([f"lock_wait:{user_id}"], timeout=remaining)
 
 
-async def release_lock(user_id: str):
-    """Release the lock on user_id."""
-    client = get_client()
-    await client.delete(f"lock:{user_id}")
+async def release_lock(user_id: str, token: str):
+    """Release the lock on user_id, if still held with token."""
+    await _release_lock_script(
+        keys=[f"lock:{user_id}", f"lock_wait:{user_id}"], args=[token]
+    )
@@ -1,7 +1,9 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 import os
 import logging
-import httpx
+import orjson
+from urllib.parse import quote, urlencode
 from dotenv import load_dotenv
 from fastapi import HTTPException
 from google.oauth2.credentials import Credentials
@@ -14,7 +16,7 @@ from .db import (
     has_user_token,
     update_user_token,
 )
-from . import cache
+from . import cache, http
 
 load_dotenv()
 
@@ -24,10 +26,36 @@ CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
 
+AUTH_URL = "https://accounts.google.com/o/oauth2/v2/auth"
+SCOPES = (
+    "email",
+    "profile",
+    "https://www.googleapis.com/auth/gmail.readonly",
+    "https://www.googleapis.com/auth/gmail.compose",
+    "https://www.googleapis.com/auth/gmail.send",
+)
+# Tokens this close to expiry are still served, but refreshed in the background
+REFRESH_AHEAD = timedelta(minutes=5)
 
-async def store_user_credentials(user_id: str, data: dict):
+# Everything but the per-user state is constant, so encode it once
+_BASE_QS = urlencode(
+    {
+        "client_id": CLIENT_ID,
+        "redirect_uri": REDIRECT_URI,
+        "response_type": "code",
+        "scope": " ".join(SCOPES),
+        "access_type": "offline",
+        "prompt": "consent",
+    }
+)
+
+# Strong references to running refreshes, so they aren't garbage collected
+_background_refreshes: set[asyncio.Task] = set()
+
+
+async def store_user_credentials(user_id: str, data: dict) -> dict:
     """Stores the user's credentials."""
-    await store_user_token(user_id, data)
+    return await store_user_token(user_id, data)
 
 
 async def has_user_credentials(user_id: str) -> bool:
@@ -35,18 +63,72 @@ async def has_user_credentials(user_id: str) -> bool:
     return True if creds else False
 
 
+async def resolve_auth(user_id: str) -> bool:
+    """Checks if the user has credentials - prioritise cache over db."""
+    has_auth = await cache.get_user_auth_state(user_id)
+    if has_auth is None:
+        has_auth = await has_user_credentials(user_id)
+        await cache.fill_user_auth_state(user_id, has_auth)  # read-through
+    return has_auth
+
+
+async def get_valid_user_token(user_id: str) -> dict | None:
+    """Retrieves the stored tokens for a given user, refreshed if expired.
+
+    Tokens about to expire are returned as-is while a refresh runs behind.
+    """
+    # Cached tokens expire with the access token, so never need an inline refresh
+    creds = await cache.get_user_token(user_id)
+    if creds is None:
+        try:
+            creds = await get_user_token(user_id)
+        except NoCredentialsFound:
+            return None
+
+        # check if needs a refresh (check expired); refresh; store
+        if creds["expires_at"] < datetime.now():
+            return await refresh_access_token(user_id, creds["refresh_token"])
+
+        await cache.fill_user_token(user_id, creds)  # read-through, no invalidation
+
+    if creds["expires_at"] - datetime.now() < REFRESH_AHEAD:
+        schedule_refresh(user_id, creds["refresh_token"])
+
+    return creds
+
+
+def schedule_refresh(user_id: str, refresh_token: str):
+    """Refreshes the user's tokens in the background, off the request path."""
+    task = asyncio.create_task(_refresh_in_background(user_id, refresh_token))
+    _background_refreshes.add(task)
+    task.add_done_callback(_background_refreshes.discard)
+
+
+async def _refresh_in_background(user_id: str, refresh_token: str):
+    # Skip if another request (or worker) is already refreshing this user
+    lock_token = await cache.acquire_lock(f"refresh:{user_id}", timeout_secs=0)
+    if lock_token is None:
+        return
+
+    try:
+        await refresh_access_token(user_id, refresh_token)
+    except Exception as e:
+        _logger.error(f"Background token refresh failed: {e}")
+    finally:
+        await cache.release_lock(f"refresh:{user_id}", lock_token)
+
+
 async def get_user_credentials(user_id: str) -> Credentials:
     """Retrieves the stored credentials for a given user."""
-    try:
-        creds = await get_user_token(user_id)
-    except NoCredentialsFound:
+    creds = await get_valid_user_token(user_id)
+    if creds is None:
         return None
 
-    # check if needs a refresh (check expired); refresh; store
-    if creds["expires_at"] < datetime.now():
-        await refresh_access_token(user_id, creds["refresh_token"])
-        creds = await get_user_token(user_id)
+    return to_credentials(creds)
 
+
+def to_credentials(creds: dict) -> Credentials:
+    """Builds Google credentials from the user's stored tokens."""
     credentials = Credentials(
         token=creds["access_token"],
         refresh_token=creds["refresh_token"],
@@ -59,19 +141,8 @@ async def get_user_credentials(user_id: str) -> Credentials:
 
 
 def get_auth_url(user_id: str, channel: str, thread_ts: str) -> str:
-    auth_url = (
-        f"https://accounts.google.com/o/oauth2/v2/auth"
-        f"?client_id={CLIENT_ID}"
-        f"&redirect_uri={REDIRECT_URI}"
-        f"&response_type=code"
-        f"&scope=email profile "
-        f"https://www.googleapis.com/auth/gmail.readonly "
-        f"https://www.googleapis.com/auth/gmail.compose "
-        f"https://www.googleapis.com/auth/gmail.send"
-        f"&access_type=offline"
-        f"&prompt=consent"
-        f"&state={user_id},{channel},{thread_ts}"
-    )
+    state = quote(f"{user_id}|{channel}|{thread_ts or ''}", safe="")
+    auth_url = f"{AUTH_URL}?{_BASE_QS}&state={state}"
 
     _logger.info(f"Auth url: {auth_url}")
 
@@ -88,18 +159,19 @@ async def get_access_token(code: str) -> dict:
         "grant_type": "authorization_code",
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(token_url, data=data)
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code, detail=response.json()
-            )
-        data = response.json()
-    return data
+    response = await http.get_client().post(token_url, data=data)
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code, detail=orjson.loads(response.content)
+        )
+    return orjson.loads(response.content)
 
 
 async def refresh_access_token(user_id: str, refresh_token: str) -> dict:
-    """Helper function to refresh Google OAuth2 access token."""
+    """Helper function to refresh Google OAuth2 access token.
+
+    Returns the stored tokens, so callers need not read them back.
+    """
     token_url = "https://oauth2.googleapis.com/token"
     data = {
         "client_id": CLIENT_ID,
@@ -108,47 +180,55 @@ async def refresh_access_token(user_id: str, refresh_token: str) -> dict:
         "grant_type": "refresh_token",
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(token_url, data=data)
+    response = await http.get_client().post(token_url, data=data)
 
-        if response.status_code == 200:
-            data = response.json()
-            await update_user_token(user_id, data)  # update
-            await cache.set_user_token(user_id, data)  # update cache
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        tokens = await update_user_token(user_id, data)  # update
+        await cache.set_user_token(user_id, tokens)  # update cache
 
-            _logger.info("Token successfully refreshed")
-            return response.json()
-        else:
-            raise HTTPException(
-                status_code=response.status_code, detail="Failed to refresh token"
-            )
+        _logger.info("Token successfully refreshed")
+        return tokens
+    else:
+        raise HTTPException(
+            status_code=response.status_code, detail="Failed to refresh token"
+        )
 
 
-async def revoke_credentials(user_id: str):
-    """Revokes the token on Google's side."""
-    token = await get_user_token(user_id)
+async def revoke_credentials(user_id: str) -> bool:
+    """Revokes the user's tokens with Google and drops them from the DB and cache.
 
-    if token["expires_at"] < datetime.now():
-        await refresh_access_token(user_id, token["refresh_token"])
+    Returns False if the user has no tokens.
+    """
+    try:
         token = await get_user_token(user_id)
+    except NoCredentialsFound:
+        # The cache may still claim tokens (e.g. a failed earlier removal)
+        await cache.remove_user_token(user_id)
+        return False
 
     access_token = token["access_token"]
+    if token["expires_at"] < datetime.now():
+        # The refreshed tokens come back directly; no need to re-read them
+        tokens = await refresh_access_token(user_id, token["refresh_token"])
+        access_token = tokens["access_token"]
 
     revoke_url = "https://oauth2.googleapis.com/revoke"
     data = {"token": access_token}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            revoke_url,
-            data=data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
+    response = await http.get_client().post(
+        revoke_url,
+        data=data,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    if response.status_code == 200:
+        _logger.info("Token successfully revoked")
+    else:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail="Failed to revoke token on Google side",
         )
-        if response.status_code == 200:
-            _logger.info("Token successfully revoked")
-        else:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail="Failed to revoke token on Google side",
-            )
-
-    await delete_user_token(user_id)
+
+    # Postgres and Redis are independent; drop both stores concurrently
+    await asyncio.gather(delete_user_token(user_id), cache.remove_user_token(user_id))
+    return True
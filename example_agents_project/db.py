@@ -1,9 +1,10 @@
 import os
 from datetime import datetime, timedelta
+import asyncpg
 from dotenv import load_dotenv
 from sqlalchemy import Column, String, Text, text, TIMESTAMP
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import declarative_base
 import logging
 
 load_dotenv()
@@ -14,24 +15,47 @@ DB_HOST = os.getenv("DB_HOST")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 5))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
 
 if not all([DB_HOST, DB_NAME, DB_USER, DB_PASSWORD]):
     raise ValueError("One or more required environment variables are missing.")
 
 DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+POOL_DSN = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
 _logger.info(f"Database URL: {DATABASE_URL}")
 
 QUERY_DBS = "SELECT 1 FROM pg_database WHERE datname = :dbname"
 
+# Token queries run directly on the asyncpg pool (prepared once per connection)
+QUERY_UPSERT_TOKEN = """
+    INSERT INTO user_tokens (user_id, access_token, refresh_token, expires_at, scopes)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (user_id) DO UPDATE SET
+        access_token = EXCLUDED.access_token,
+        refresh_token = EXCLUDED.refresh_token,
+        expires_at = EXCLUDED.expires_at,
+        scopes = EXCLUDED.scopes
+    RETURNING access_token, refresh_token, expires_at, scopes
+"""
+QUERY_UPDATE_TOKEN = """
+    UPDATE user_tokens SET access_token = $2, expires_at = $3, scopes = $4
+    WHERE user_id = $1
+    RETURNING access_token, refresh_token, expires_at, scopes
+"""
+QUERY_HAS_TOKEN = "SELECT EXISTS (SELECT 1 FROM user_tokens WHERE user_id = $1)"
+QUERY_GET_TOKEN = """
+    SELECT access_token, refresh_token, expires_at, scopes
+    FROM user_tokens WHERE user_id = $1
+"""
+QUERY_DELETE_TOKEN = "DELETE FROM user_tokens WHERE user_id = $1"
+TOKEN_COLUMNS = ("user_id", "access_token", "refresh_token", "expires_at", "scopes")
+
 async_engine = create_async_engine(DATABASE_URL, echo=False)
-AsyncSessionLocal = sessionmaker(
-    bind=async_engine,
-    class_=AsyncSession,
-    autocommit=False,
-    autoflush=False,
-)
 Base = declarative_base()
 
+_pool: asyncpg.Pool = None
+
 
 class NoCredentialsFound(Exception):
     pass
@@ -67,66 +91,98 @@ async def create_database_if_not_exists():
 
 async def init_db():
     """Initializes the PostgreSQL database with the required table."""
+    global _pool
     await create_database_if_not_exists()  # Ensure the database exists
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
+    # Warm connections keep their prepared token statements across requests
+    _pool = await asyncpg.create_pool(
+        POOL_DSN, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE
+    )
+
+
+def get_pool() -> asyncpg.Pool:
+    return _pool
+
+
+async def close_db():
+    await _pool.close()
+
+
+def _to_dict(row: asyncpg.Record) -> dict:
+    return dict(
+        access_token=row["access_token"],
+        refresh_token=row["refresh_token"],
+        expires_at=row["expires_at"],
+        scopes=row["scopes"].split(","),
+    )
+
 
-async def store_user_token(user_id: str, data: dict):
+async def store_user_token(user_id: str, data: dict) -> dict:
     """Stores (add/update) the user's tokens."""
     _logger.info(f"Storing user token for user {user_id}: {data}")
     expires_at = datetime.now() + timedelta(seconds=data["expires_in"])
 
-    async with AsyncSessionLocal() as session:
-        token = UserToken(
-            user_id=user_id,
-            access_token=data["access_token"],
-            refresh_token=data["refresh_token"],
-            expires_at=expires_at,
-            scopes=data["scope"],
+    async with get_pool().acquire() as conn:
+        row = await conn.fetchrow(
+            QUERY_UPSERT_TOKEN,
+            user_id,
+            data["access_token"],
+            data["refresh_token"],
+            expires_at,
+            data["scope"],
         )
-        session.add(token)
-        await session.commit()
+    return _to_dict(row)
 
 
-async def update_user_token(user_id: str, data: dict):
-    """Stores (add/update) the user's tokens."""
+async def bulk_store_user_tokens(rows: list[tuple]):
+    """Inserts many users' tokens, ordered as TOKEN_COLUMNS, in one COPY.
+
+    Unlike store_user_token this doesn't upsert: any existing user fails the batch.
+    """
+    async with get_pool().acquire() as conn:
+        await conn.copy_records_to_table(
+            "user_tokens", records=rows, columns=TOKEN_COLUMNS
+        )
+
+
+async def update_user_token(user_id: str, data: dict) -> dict:
+    """Updates the user's access token (no refresh token)."""
     _logger.info(f"Storing user token for user {user_id}: {data}")
     expires_at = datetime.now() + timedelta(seconds=data["expires_in"])
 
-    async with AsyncSessionLocal() as session:
-        token = await session.get(UserToken, user_id)
-        token.access_token = data["access_token"]  # no refresh token
-        token.expires_at = expires_at
-        token.scopes = data["scope"]
-        await session.commit()
+    async with get_pool().acquire() as conn:
+        row = await conn.fetchrow(
+            QUERY_UPDATE_TOKEN,
+            user_id,
+            data["access_token"],
+            expires_at,
+            data["scope"],
+        )
+    if not row:
+        raise NoCredentialsFound("Tokens not found")
+
+    return _to_dict(row)
 
 
 async def has_user_token(user_id: str) -> bool:
-    async with AsyncSessionLocal() as session:
-        token = await session.get(UserToken, user_id)
-        return token is not None
+    async with get_pool().acquire() as conn:
+        return await conn.fetchval(QUERY_HAS_TOKEN, user_id)
 
 
 async def get_user_token(user_id: str) -> dict:
     """Retrieves the stored credentials for a given user."""
-    async with AsyncSessionLocal() as session:
-        token = await session.get(UserToken, user_id)
-        if not token:
-            raise NoCredentialsFound("Tokens not found")
-
-        return dict(
-            access_token=token.access_token,
-            refresh_token=token.refresh_token,
-            expires_at=token.expires_at,
-            scopes=token.scopes.split(","),
-        )
+    async with get_pool().acquire() as conn:
+        row = await conn.fetchrow(QUERY_GET_TOKEN, user_id)
+    if not row:
+        raise NoCredentialsFound("Tokens not found")
+
+    return _to_dict(row)
 
 
-async def delete_user_token(user_id: str):
-    """Deletes the stored tokens for a given user."""
-    async with AsyncSessionLocal() as session:
-        token = await session.get(UserToken, user_id)
-        if token:
-            await session.delete(token)
-            await session.commit()
+async def delete_user_token(user_id: str) -> bool:
+    """Deletes the stored tokens for a given user; False if there were none."""
+    async with get_pool().acquire() as conn:
+        status = await conn.execute(QUERY_DELETE_TOKEN, user_id)
+    return status != "DELETE 0"
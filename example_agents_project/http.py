@@ -0,0 +1,20 @@
+import httpx
+
+_http_client: httpx.AsyncClient = None
+
+
+async def init_client():
+    global _http_client
+    _http_client = httpx.AsyncClient(
+        timeout=10.0,
+        # Keep-alive connections skip the TLS handshake on repeat calls
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    return _http_client
+
+
+async def close_client():
+    await _http_client.aclose()
@@ -0,0 +1,186 @@
+import logging
+
+import orjson
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import cache
+
+_logger = logging.getLogger(__name__)
+
+ALL_METHODS = ("DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "POST", "PUT")
+OK_BODY = orjson.dumps({"status": "ok"})
+
+
+async def send_json(send: Send, body: bytes, status: int = 200):
+    """Sends a complete JSON response from pre-serialized bytes."""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class CORSMiddleware:
+    """Pure ASGI CORS middleware.
+
+    Headers are precomputed once and injected straight into the
+    `http.response.start` message - no Request/Response objects per call.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        allow_origins: tuple[str, ...] | list[str] = (),
+        allow_methods: tuple[str, ...] | list[str] = ("GET",),
+        allow_headers: tuple[str, ...] | list[str] = (),
+        allow_credentials: bool = False,
+        max_age: int = 600,
+    ):
+        if "*" in allow_methods:
+            allow_methods = ALL_METHODS
+
+        self.app = app
+        self.allow_all_origins = "*" in allow_origins
+        self.allow_origins = {origin.encode("latin-1") for origin in allow_origins}
+        self.allow_all_headers = "*" in allow_headers
+        # Browsers reject a wildcard origin on credentialed requests, so echo it
+        self.echo_origin = allow_credentials or not self.allow_all_origins
+
+        self.simple_headers: list[tuple[bytes, bytes]] = []
+        if allow_credentials:
+            self.simple_headers.append((b"access-control-allow-credentials", b"true"))
+
+        self.preflight_headers: list[tuple[bytes, bytes]] = [
+            *self.simple_headers,
+            (b"access-control-allow-methods", ", ".join(allow_methods).encode()),
+            (b"access-control-max-age", str(max_age).encode()),
+        ]
+        if not self.allow_all_headers:
+            self.preflight_headers.append(
+                (b"access-control-allow-headers", ", ".join(allow_headers).encode())
+            )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = request_method = request_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                request_headers = value
+
+        if origin is None or not (
+            self.allow_all_origins or origin in self.allow_origins
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        if self.echo_origin:
+            origin_headers = [
+                (b"access-control-allow-origin", origin),
+                (b"vary", b"Origin"),
+            ]
+        else:
+            origin_headers = [(b"access-control-allow-origin", b"*")]
+
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            headers = origin_headers + self.preflight_headers
+            if self.allow_all_headers and request_headers:
+                headers.append((b"access-control-allow-headers", request_headers))
+
+            await send(
+                {"type": "http.response.start", "status": 204, "headers": headers}
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        cors_headers = origin_headers + self.simple_headers
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class SlackEventsMiddleware:
+    """Pure ASGI fast path for Slack events.
+
+    URL verification, duplicate and ignorable events are answered here; only
+    message events that need handling reach the FastAPI route, with the parsed
+    event on `request.state.slack_event` so it isn't parsed twice.
+    """
+
+    def __init__(self, app: ASGIApp, path: str = "/slack/events"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] != self.path
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        try:
+            slack_event = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            slack_event = None  # left to FastAPI to reject
+
+        if isinstance(slack_event, dict):
+            if slack_event.get("type") == "url_verification":
+                _logger.info("URL verification challenge received")
+                challenge = {"challenge": slack_event.get("challenge")}
+                await send_json(send, orjson.dumps(challenge))
+                return
+
+            # Prevent duplicate events (Slack funkiness)
+            event_id = slack_event.get("event_id")
+            if not await cache.claim_event_id(event_id):
+                _logger.info("Event %s already processed", event_id)
+                await send_json(send, OK_BODY)
+                return
+
+            event_data = slack_event.get("event")
+            if not (
+                event_data
+                and event_data.get("type") == "message"
+                and "bot_id" not in event_data
+            ):
+                await send_json(send, OK_BODY)
+                return
+
+            scope.setdefault("state", {})["slack_event"] = slack_event
+
+        body_sent = False
+
+        async def replay_receive() -> Message:
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app(scope, replay_receive, send)
@@ -1,26 +1,29 @@
-import httpx
 import logging
 import os
+import orjson
 from dotenv import load_dotenv
 
+from . import http
+
 load_dotenv()
 
 _logger = logging.getLogger(__name__)
 
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
+SLACK_URL = "https://slack.com/api/chat.postMessage"
+HEADERS = {
+    "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
+    "Content-Type": "application/json",
+}
 
+# Serialized `blocks` arrays for canned messages, built once at import time
+_prebuilt_blocks: dict[str, bytes] = {}
 
-async def send_slack_message(message: str, channel: str, thread_ts: str = None):
-    """Helper function to send a message to a Slack user, optionally in a thread."""
-    slack_url = "https://slack.com/api/chat.postMessage"
-    headers = {
-        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-        "Content-Type": "application/json",
-    }
-
-    data = {
-        "channel": channel,
-        "blocks": [
+
+def _dump_blocks(message: str) -> bytes:
+    """Serializes the `blocks` array for a single mrkdwn section."""
+    return orjson.dumps(
+        [
             {
                 "type": "section",
                 "text": {
@@ -28,15 +31,27 @@ async def send_slack_message(message: str, channel: str, thread_ts: str = None):
                     "text": message,
                 },
             }
-        ],
-    }
+        ]
+    )
+
+
+def prebuild_message(message: str) -> str:
+    """Registers a static message so its blocks are serialized only once."""
+    _prebuilt_blocks[message] = _dump_blocks(message)
+    return message
+
+
+async def send_slack_message(message: str, channel: str, thread_ts: str = None):
+    """Helper function to send a message to a Slack user, optionally in a thread."""
+    blocks = _prebuilt_blocks.get(message) or _dump_blocks(message)
 
+    body = b'{"channel":' + orjson.dumps(channel)
     if thread_ts is not None:
-        data["thread_ts"] = thread_ts
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(slack_url, headers=headers, json=data)
-        if response.status_code != 200:
-            _logger.error(f"Failed to send message: {response.json()}")
-        else:
-            _logger.info(f"Message sent to channel {channel} in thread {thread_ts}")
+        body += b',"thread_ts":' + orjson.dumps(thread_ts)
+    body += b',"blocks":' + blocks + b"}"
+
+    response = await http.get_client().post(SLACK_URL, headers=HEADERS, content=body)
+    if response.status_code != 200:
+        _logger.error(f"Failed to send message: {orjson.loads(response.content)}")
+    else:
+        _logger.info(f"Message sent to channel {channel} in thread {thread_ts}")
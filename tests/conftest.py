@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from example_agents_project import api
+
+from .helpers import FastAsyncMock
+
+try:
+    import uvloop
+except ImportError:  # optional; falls back to the default asyncio loop
+    uvloop = None
+
+
+@pytest.fixture(scope="session")
+def event_loop_policy():
+    """Runs async tests on uvloop when it is installed."""
+    if uvloop is not None:
+        return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
+# Built once per process; api_mocks resets them between tests
+_MOCKS = SimpleNamespace(
+    claim_event_id=FastAsyncMock(),
+    send_slack_message=FastAsyncMock(),
+    resolve_auth=FastAsyncMock(),
+    get_auth_url=MagicMock(),
+    revoke_credentials=FastAsyncMock(),
+    evict_user=MagicMock(),
+    get_user_credentials=FastAsyncMock(),
+    process_message=FastAsyncMock(),
+)
+_CACHE_MOCKS = ("claim_event_id",)
+_DEFAULT_RETURN_VALUES = {
+    "claim_event_id": True,
+    "resolve_auth": False,
+    "get_auth_url": "http://auth.url",
+    "revoke_credentials": False,
+    "get_user_credentials": False,
+}
+
+
+@pytest.fixture
+def api_mocks(monkeypatch):
+    """Replaces the API's collaborators with mocks; tests tweak return values."""
+    for name, mock in vars(_MOCKS).items():
+        mock.reset_mock(return_value=True, side_effect=True)
+        if name in _DEFAULT_RETURN_VALUES:
+            mock.return_value = _DEFAULT_RETURN_VALUES[name]
+        target = api.cache if name in _CACHE_MOCKS else api
+        monkeypatch.setattr(target, name, mock)
+
+    # No BackgroundTasks patch needed: the response's background tasks run
+    # before the app call returns, so their calls can be asserted directly
+    return _MOCKS
@@ -0,0 +1,73 @@
+from collections.abc import Iterator
+from unittest.mock import call
+
+
+def _is_exception(obj) -> bool:
+    return isinstance(obj, BaseException) or (
+        isinstance(obj, type) and issubclass(obj, BaseException)
+    )
+
+
+class FastAsyncMock:
+    """Minimal async stub: records calls and returns `return_value`.
+
+    Cheaper than AsyncMock for collaborators whose calls are all we assert.
+    `side_effect` may be an exception, an iterable of results or a callable.
+    """
+
+    def __init__(self, return_value=None, side_effect=None):
+        self.return_value = return_value
+        self.side_effect = side_effect
+        self.calls = []
+
+    async def __call__(self, *args, **kwargs):
+        self.calls.append(call(*args, **kwargs))
+        effect = self.side_effect
+        if effect is None:
+            return self.return_value
+        if _is_exception(effect):
+            raise effect
+        if callable(effect):
+            return effect(*args, **kwargs)
+
+        # Iterables yield one result per call, as with AsyncMock
+        if not isinstance(effect, Iterator):
+            effect = self.side_effect = iter(effect)
+        try:
+            result = next(effect)
+        except StopIteration:
+            raise StopAsyncIteration
+        if _is_exception(result):
+            raise result
+        return result
+
+    @property
+    def call_count(self) -> int:
+        return len(self.calls)
+
+    @property
+    def call_args(self):
+        return self.calls[-1] if self.calls else None
+
+    @property
+    def call_args_list(self) -> list:
+        return self.calls
+
+    def assert_called_once(self):
+        assert len(self.calls) == 1, f"calls: {self.calls}"
+
+    def assert_called_once_with(self, *args, **kwargs):
+        assert self.calls == [call(*args, **kwargs)], f"calls: {self.calls}"
+
+    def assert_called_with(self, *args, **kwargs):
+        assert self.call_args == call(*args, **kwargs), f"calls: {self.calls}"
+
+    def assert_not_called(self):
+        assert not self.calls, f"calls: {self.calls}"
+
+    def reset_mock(self, return_value=False, side_effect=False):
+        self.calls.clear()
+        if return_value:
+            self.return_value = None
+        if side_effect:
+            self.side_effect = None
@@ -0,0 +1,150 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from example_agents_project.db import NoCredentialsFound
+from example_agents_project.agent import (
+    FailedToAcquireSessionLockException,
+    compiled_apps,
+    tools_cache,
+    evict_user,
+    get_tools,
+    process_message,
+    user_lock,
+)
+
+
+def _creds(access_token: str = "token") -> dict:
+    return {
+        "access_token": access_token,
+        "refresh_token": "refresh",
+        "scopes": ["scope"],
+    }
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    compiled_apps.clear()
+    tools_cache.clear()
+    yield
+    compiled_apps.clear()
+    tools_cache.clear()
+
+
+@pytest.fixture
+def mock_toolkit():
+    with patch("langchain_google_community.GmailToolkit") as mock_toolkit, patch(
+        "langchain_google_community.gmail.utils.build_resource_service"
+    ):
+        yield mock_toolkit
+
+
+@pytest.fixture
+def mock_workflow():
+    """Patches get_workflow; each build records its tools as get_tools would."""
+    workflow = MagicMock()
+    app = workflow.compile.return_value
+    app.ainvoke = AsyncMock(return_value={"messages": [MagicMock(content="reply")]})
+
+    async def build(user_id, creds):
+        tools_cache[user_id] = ([], creds["access_token"])
+        return workflow
+
+    with patch(
+        "example_agents_project.agent.get_workflow", side_effect=build
+    ) as mock_get_workflow, patch(
+        "example_agents_project.agent.acquire_lock",
+        new_callable=AsyncMock,
+        return_value="lock_token",
+    ), patch(
+        "example_agents_project.agent.release_lock", new_callable=AsyncMock
+    ):
+        yield mock_get_workflow
+
+
+@pytest.mark.asyncio
+async def test_get_tools_reused_for_same_token(mock_toolkit):
+    tools = await get_tools("test_user", _creds())
+    assert await get_tools("test_user", _creds()) is tools
+    mock_toolkit.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_get_tools_rebuilt_for_new_token(mock_toolkit):
+    await get_tools("test_user", _creds("old_token"))
+    await get_tools("test_user", _creds("new_token"))
+    assert mock_toolkit.call_count == 2
+    assert tools_cache["test_user"][1] == "new_token"
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.agent.get_valid_user_token", new_callable=AsyncMock)
+async def test_process_message_reuses_app(mock_get_token, mock_workflow):
+    mock_get_token.return_value = _creds()
+
+    assert await process_message("test_user", "hi") == "reply"
+    assert await process_message("test_user", "hi again") == "reply"
+    mock_workflow.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.agent.get_valid_user_token", new_callable=AsyncMock)
+async def test_process_message_rebuilds_after_reauth(mock_get_token, mock_workflow):
+    # e.g. revoked and re-authed via another worker, so no local eviction ran
+    mock_get_token.side_effect = [_creds("old_token"), _creds("new_token")]
+
+    await process_message("test_user", "hi")
+    await process_message("test_user", "hi again")
+    assert mock_workflow.call_count == 2
+    assert mock_workflow.call_args.args == ("test_user", _creds("new_token"))
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.agent.get_valid_user_token", new_callable=AsyncMock)
+async def test_process_message_without_credentials(mock_get_token, mock_workflow):
+    mock_get_token.return_value = None
+
+    with pytest.raises(NoCredentialsFound):
+        await process_message("test_user", "hi")
+    mock_workflow.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_process_message_missing_fields():
+    # Replies go straight to Slack, so even errors are plain text
+    assert isinstance(await process_message("test_user", ""), str)
+
+
+def test_evict_user():
+    compiled_apps["test_user"] = MagicMock()
+    tools_cache["test_user"] = ([], "token")
+    compiled_apps["other_user"] = MagicMock()
+
+    evict_user("test_user")
+    assert "test_user" not in compiled_apps
+    assert "test_user" not in tools_cache
+    assert "other_user" in compiled_apps
+
+    evict_user("test_user")  # no-op when nothing is cached
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.agent.release_lock", new_callable=AsyncMock)
+@patch("example_agents_project.agent.acquire_lock", new_callable=AsyncMock)
+async def test_user_lock_released_on_error(mock_acquire, mock_release):
+    mock_acquire.return_value = "lock_token"
+
+    with pytest.raises(ValueError):
+        async with user_lock("test_user"):
+            raise ValueError("graph run failed")
+    mock_release.assert_called_once_with("test_user", "lock_token")
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.agent.release_lock", new_callable=AsyncMock)
+@patch("example_agents_project.agent.acquire_lock", new_callable=AsyncMock)
+async def test_user_lock_timeout(mock_acquire, mock_release):
+    mock_acquire.return_value = None
+
+    with pytest.raises(FailedToAcquireSessionLockException):
+        async with user_lock("test_user"):
+            pass
+    mock_release.assert_not_called()
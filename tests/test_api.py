@@ -1,446 +1,422 @@
+import orjson
 import pytest
-import pytest_asyncio
-from httpx import AsyncClient, ASGITransport
-from unittest.mock import AsyncMock, patch
-from example_agents_project.api import app
+from functools import cache
+from typing import NamedTuple
+from unittest.mock import AsyncMock, MagicMock, patch
+from example_agents_project.api import app, lifespan, parse_command
+from example_agents_project.db import NoCredentialsFound
 from fastapi import status
 
 
-@pytest_asyncio.fixture
-async def test_client():
-    """Fixture for creating an async test client."""
-    transport = ASGITransport(app=app)  # Create ASGI transport for FastAPI app
-    async with AsyncClient(transport=transport, base_url="http://test") as client:
-        yield client
+class _Response(NamedTuple):
+    status_code: int
+    headers: dict[str, str]
+    content: bytes
+
+    def json(self):
+        return orjson.loads(self.content)
+
+
+async def call(
+    method: str, path: str, body: bytes = b"", headers: dict[str, str] = None
+) -> _Response:
+    """Calls the ASGI app in-process, skipping the HTTP client layer."""
+    path, _, query = path.partition("?")
+    headers = {"content-type": "application/json", **(headers or {})}
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": ("test", 123),
+        "server": ("test", 80),
+    }
+    messages = []
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if body_sent:
+            return {"type": "http.disconnect"}
+        body_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+
+    start = messages[0]
+    return _Response(
+        status_code=start["status"],
+        headers={k.decode(): v.decode() for k, v in start.get("headers", ())},
+        content=b"".join(m.get("body", b"") for m in messages[1:]),
+    )
 
 
-@pytest.mark.asyncio
-async def test_health_check(test_client):
-    """Test /health endpoint."""
-    response = await test_client.get("/health")
-    assert response.status_code == status.HTTP_200_OK
-    assert response.json() == {"status": "ok"}
+_OK_BODY = b'{"status":"ok"}'
+_BASE_EVENT = {
+    "type": "event_callback",
+    "event_id": "event123",
+    "event": {
+        "type": "message",
+        "user": "user123",
+        "channel": "channel456",
+        "text": "",
+        "thread_ts": "1234567890.123456",
+    },
+}
+
+
+@cache
+def _body(text: str) -> bytes:
+    """Serializes the base message event with the given text (once per text)."""
+    return orjson.dumps(
+        {**_BASE_EVENT, "event": {**_BASE_EVENT["event"], "text": text}}
+    )
 
 
-@pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_hello(
-    mock_background_tasks,
-    mock_send_slack_message,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'hello' message."""
+async def _post_event(text: str) -> _Response:
+    """Posts a Slack message event from user123 in channel456's thread."""
+    return await call("POST", "/slack/events", _body(text))
 
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
 
-    payload = {
+# Static request bodies, serialized once at import
+_DUPLICATE_BODY = orjson.dumps(
+    {"type": "event_callback", "event_id": "duplicate_event"}
+)
+_URL_VERIFICATION_BODY = orjson.dumps(
+    {"type": "url_verification", "challenge": "test_challenge"}
+)
+_BOT_MESSAGE_BODY = orjson.dumps(
+    {
         "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "hello",
-            "thread_ts": "1234567890.123456",
-        },
+        "event_id": "bot_event",
+        "event": {"type": "message", "bot_id": "B123", "text": "hello"},
     }
+)
 
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
 
+@pytest.mark.asyncio
+async def test_health_check():
+    """Test /health endpoint."""
+    response = await call("GET", "/health")
     assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_send_slack_message.assert_called_once_with(
-        "Hello! I'm here to help!\n"
-        "First you need to authenticate (message: `auth`).\n"
-        "You can check your authentication status (message: `status`).\n"
-        "Then I can help manage your emails (read; send; draft) (message: `chat`).\n"
-        "Finally, you can revoke credentials (message: `revoke`).\n",
-        "channel456",
-        "1234567890.123456",
-    )
+    assert response.content == _OK_BODY
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.cache.exists_user_token", return_value=False)
-@patch("example_agents_project.api.has_user_credentials", return_value=False)
-@patch("example_agents_project.api.get_auth_url", return_value="http://auth.url")
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_auth(
-    mock_background_tasks,
-    mock_send_message,
-    mock_get_auth_url,
-    mock_has_user_credentials,
-    mock_exists_user_token,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'auth' message."""
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "auth",
-            "thread_ts": "1234567890.123456",
-        },
-    }
-
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
-
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
-
+async def test_cors_simple_request():
+    """Test CORS headers are added to a simple request."""
+    response = await call("GET", "/health", headers={"Origin": "http://example.com"})
     assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_exists_user_token.assert_called_once_with("user123")
-    mock_has_user_credentials.assert_called_once_with("user123")
-    mock_get_auth_url.assert_called_once_with(
-        "user123", "channel456", "1234567890.123456"
-    )
-    mock_send_message.assert_called_once_with(
-        "Please click <http://auth.url|here> to authenticate with Google.",
-        "channel456",
-        "1234567890.123456",
-    )
+    assert response.headers["access-control-allow-origin"] == "http://example.com"
+    assert response.headers["access-control-allow-credentials"] == "true"
+    assert response.content == _OK_BODY
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.cache.exists_user_token", return_value=False)
-@patch("example_agents_project.api.has_user_credentials", return_value=False)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_status(
-    mock_background_tasks,
-    mock_send_message,
-    mock_exists_user_token,
-    mock_has_user_credentials,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'status' message."""
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "status",
-            "thread_ts": "1234567890.123456",
+async def test_cors_preflight():
+    """Test CORS preflight request is answered by the middleware."""
+    response = await call(
+        "OPTIONS",
+        "/slack/events",
+        headers={
+            "Origin": "http://example.com",
+            "Access-Control-Request-Method": "POST",
+            "Access-Control-Request-Headers": "content-type",
         },
-    }
-
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
     )
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert response.headers["access-control-allow-origin"] == "http://example.com"
+    assert "POST" in response.headers["access-control-allow-methods"]
+    assert response.headers["access-control-allow-headers"] == "content-type"
 
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
 
-    assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_exists_user_token.assert_called_once_with("user123")
-    mock_has_user_credentials.assert_called_once_with("user123")
-    mock_send_message.assert_called_once_with(
-        "You don't have existing credentials.\nUse `auth` to authenticate.",
-        "channel456",
-        "1234567890.123456",
-    )
+@pytest.mark.asyncio
+async def test_no_cors_headers_without_origin():
+    """Test no CORS headers are added when there is no Origin header."""
+    response = await call("GET", "/health")
+    assert "access-control-allow-origin" not in response.headers
+
+
+# Expected Slack replies
+HELLO_REPLY = (
+    "Hello! I'm here to help!\n"
+    "First you need to authenticate (message: `auth`).\n"
+    "You can check your authentication status (message: `status`).\n"
+    "Then I can help manage your emails (read; send; draft) (message: `chat`).\n"
+    "Finally, you can revoke credentials (message: `revoke`).\n"
+)
+AUTH_SUCCESS = (
+    "Success! You have authenticated with Google. You can use the `chat` now."
+)
+AUTH_REPLY = "Please click <http://auth.url|here> to authenticate with Google."
+STATUS_AUTHED = "You have existing credentials.\nYou can use `chat` to send messages."
+STATUS_NO_CREDS = "You don't have existing credentials.\nUse `auth` to authenticate."
+REVOKE_OK = "Credentials revoked successfully."
+REVOKE_NO_CREDS = "You don't have existing credentials. Use `auth` to authenticate."
+CHAT_REPLY = "This is a chat response."
+CHAT_NO_AUTH = "You are not authenticated with Google. Please use `auth` first."
+CHAT_SESSION_START = (
+    "Chat session started. Please provide instructions; "
+    "use `chat: <message>` for chat messages."
+)
+
+_USER = ("user123",)
+_REPLY_TO = ("channel456", "1234567890.123456")
+
+# (text, mock return values, expected reply, expected calls; None = not called)
+SLACK_MESSAGE_CASES = [
+    pytest.param(
+        "hello",
+        {},
+        HELLO_REPLY,
+        {},
+        id="hello",
+    ),
+    pytest.param(
+        "auth",
+        {},
+        AUTH_REPLY,
+        {"resolve_auth": _USER, "get_auth_url": _USER + _REPLY_TO},
+        id="auth",
+    ),
+    pytest.param(
+        "status",
+        {"resolve_auth": True},
+        STATUS_AUTHED,
+        {"resolve_auth": _USER},
+        id="status-authed",
+    ),
+    pytest.param(
+        "status",
+        {},
+        STATUS_NO_CREDS,
+        {"resolve_auth": _USER},
+        id="status-no-auth",
+    ),
+    pytest.param(
+        "revoke",
+        {"revoke_credentials": True},
+        REVOKE_OK,
+        {"revoke_credentials": _USER, "evict_user": _USER},
+        id="revoke-with-credentials",
+    ),
+    pytest.param(
+        "revoke",
+        {},
+        REVOKE_NO_CREDS,
+        {"revoke_credentials": _USER, "evict_user": None},
+        id="revoke-without-credentials",
+    ),
+    pytest.param(
+        "chat: Hello there!",
+        {"get_user_credentials": True, "process_message": CHAT_REPLY},
+        CHAT_REPLY,
+        {"get_user_credentials": _USER, "process_message": _USER + ("Hello there!",)},
+        id="chat-with-message",
+    ),
+    pytest.param(
+        "chat: Hello there!",
+        {},
+        CHAT_NO_AUTH,
+        {"get_user_credentials": _USER, "process_message": None},
+        id="chat-without-credentials",
+    ),
+    pytest.param(
+        "chat",
+        {"get_user_credentials": True},
+        CHAT_SESSION_START,
+        {"get_user_credentials": _USER},
+        id="chat-without-message",
+    ),
+]
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.has_user_credentials", return_value=True)
-@patch("example_agents_project.api.revoke_credentials", new_callable=AsyncMock)
-@patch("example_agents_project.api.cache.remove_user_token", new_callable=AsyncMock)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_revoke_with_credentials(
-    mock_background_tasks,
-    mock_send_message,
-    mock_remove_user_token,
-    mock_revoke_credentials,
-    mock_has_user_credentials,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'revoke' message when credentials exist."""
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "revoke",
-            "thread_ts": "1234567890.123456",
-        },
-    }
-
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
+@pytest.mark.parametrize("text, return_values, reply, calls", SLACK_MESSAGE_CASES)
+async def test_slack_events_message(api_mocks, text, return_values, reply, calls):
+    """Test /slack/events endpoint replies to each command."""
+    for name, value in return_values.items():
+        getattr(api_mocks, name).return_value = value
 
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
+    response = await _post_event(text)
 
     assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_has_user_credentials.assert_called_once_with("user123")
-    mock_revoke_credentials.assert_called_once_with("user123")
-    mock_remove_user_token.assert_called_once_with("user123")
-    mock_send_message.assert_called_once_with(
-        "Credentials revoked successfully.",
-        "channel456",
-        "1234567890.123456",
-    )
+    api_mocks.claim_event_id.assert_called_once_with("event123")
+    for name, args in calls.items():
+        if args is None:
+            getattr(api_mocks, name).assert_not_called()
+        else:
+            getattr(api_mocks, name).assert_called_once_with(*args)
+    api_mocks.send_slack_message.assert_called_once_with(reply, *_REPLY_TO)
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.has_user_credentials", return_value=False)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_revoke_without_credentials(
-    mock_background_tasks,
-    mock_send_message,
-    mock_has_user_credentials,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'revoke' message when no credentials exist."""
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "revoke",
-            "thread_ts": "1234567890.123456",
-        },
-    }
+async def test_slack_events_chat_revoked_mid_flight(api_mocks):
+    """Test chat replies with text when the tokens vanish after the check."""
+    api_mocks.get_user_credentials.return_value = True
+    api_mocks.process_message.side_effect = NoCredentialsFound("Tokens not found")
 
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
-
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
+    response = await _post_event("chat: Hello there!")
 
     assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_has_user_credentials.assert_called_once_with("user123")
-    mock_send_message.assert_called_once_with(
-        "You don't have existing credentials. Use `auth` to authenticate.",
-        "channel456",
-        "1234567890.123456",
-    )
+    api_mocks.send_slack_message.assert_called_once_with(CHAT_NO_AUTH, *_REPLY_TO)
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.get_user_credentials", return_value=True)
-@patch("example_agents_project.api.process_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_chat_with_message(
-    mock_background_tasks,
-    mock_send_message,
-    mock_process_message,
-    mock_get_user_credentials,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'chat' message."""
-    mock_process_message.return_value = "This is a chat response."
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "chat: Hello there!",
-            "thread_ts": "1234567890.123456",
-        },
-    }
+async def test_slack_events_duplicate_event(api_mocks):
+    """Test /slack/events endpoint with duplicate event."""
+    api_mocks.claim_event_id.return_value = False
 
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
+    response = await call("POST", "/slack/events", _DUPLICATE_BODY)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == _OK_BODY
+    api_mocks.claim_event_id.assert_called_once_with("duplicate_event")
+    api_mocks.send_slack_message.assert_not_called()
 
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
 
+@pytest.mark.asyncio
+async def test_slack_events_url_verification(api_mocks):
+    """Test /slack/events endpoint with url_verification event."""
+    response = await call("POST", "/slack/events", _URL_VERIFICATION_BODY)
     assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_get_user_credentials.assert_called_once_with("user123")
-    mock_process_message.assert_called_once_with("user123", "Hello there!")
-    mock_send_message.assert_called_once_with(
-        "This is a chat response.", "channel456", "1234567890.123456"
-    )
+    assert response.content == b'{"challenge":"test_challenge"}'
+    api_mocks.claim_event_id.assert_not_called()
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.get_user_credentials", return_value=False)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_chat_without_credentials(
-    mock_background_tasks,
-    mock_send_message,
-    mock_get_user_credentials,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with 'chat' message when not authenticated."""
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "chat: Hello there!",
-            "thread_ts": "1234567890.123456",
-        },
-    }
-
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
+async def test_slack_events_bot_message_ignored(api_mocks):
+    """Test /slack/events endpoint ignores bot messages."""
+    response = await call("POST", "/slack/events", _BOT_MESSAGE_BODY)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == _OK_BODY
+    api_mocks.claim_event_id.assert_called_once_with("bot_event")
+    api_mocks.send_slack_message.assert_not_called()
 
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
 
-    assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_get_user_credentials.assert_called_once_with("user123")
-    mock_send_message.assert_called_once_with(
-        "You are not authenticated with Google. Please use `auth` first.",
-        "channel456",
-        "1234567890.123456",
-    )
+@pytest.mark.asyncio
+async def test_slack_events_invalid_body(api_mocks):
+    """Test /slack/events endpoint rejects a non-JSON body."""
+    response = await call("POST", "/slack/events", b"not json")
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=False)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-@patch("example_agents_project.api.get_user_credentials", return_value=True)
-@patch("example_agents_project.api.send_slack_message", new_callable=AsyncMock)
-@patch("example_agents_project.api.BackgroundTasks")
-async def test_slack_events_chat_without_message(
-    mock_background_tasks,
-    mock_send_message,
-    mock_get_user_credentials,
-    mock_add_event_id,
-    mock_exists_event_id,
-    test_client,
-):
-    """Test /slack/events endpoint with empty 'chat' message."""
-    payload = {
-        "type": "event_callback",
-        "event_id": "event123",
-        "event": {
-            "type": "message",
-            "user": "user123",
-            "channel": "channel456",
-            "text": "chat",
-            "thread_ts": "1234567890.123456",
-        },
-    }
+async def test_slack_events_non_object_body(api_mocks):
+    """Test /slack/events endpoint rejects JSON that isn't an object."""
+    response = await call("POST", "/slack/events", b"[1, 2]")
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    api_mocks.claim_event_id.assert_not_called()
 
-    mock_background_tasks.return_value.add_task = lambda func, *args, **kwargs: func(
-        *args, **kwargs
-    )
 
-    response = await test_client.post(
-        "/slack/events", json=payload, headers={"Content-Type": "application/json"}
-    )
+@pytest.mark.asyncio
+async def test_slack_events_parsed_once(api_mocks):
+    """Test the route reuses the middleware's parsed event (no stdlib json)."""
+    with patch("json.loads", side_effect=AssertionError("parsed twice")):
+        response = await _post_event("hello")
 
     assert response.status_code == status.HTTP_200_OK
-    mock_exists_event_id.assert_called_once_with("event123")
-    mock_add_event_id.assert_called_once_with("event123")
-    mock_get_user_credentials.assert_called_once_with("user123")
-    mock_send_message.assert_called_once_with(
-        "Chat session started. Please provide instructions; use `chat: <message>` for chat messages.",
-        "channel456",
-        "1234567890.123456",
-    )
+    api_mocks.send_slack_message.assert_called_once_with(HELLO_REPLY, *_REPLY_TO)
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.api.cache.exists_event_id", return_value=True)
-@patch("example_agents_project.api.cache.add_event_id", new_callable=AsyncMock)
-async def test_slack_events_duplicate_event(
-    mock_add_event_id, mock_exists_event_id, test_client
-):
-    """Test /slack/events endpoint with duplicate event."""
-    payload = {"type": "event_callback", "event_id": "duplicate_event"}
-    response = await test_client.post("/slack/events", json=payload)
-    assert response.status_code == status.HTTP_200_OK
-    assert response.json() == {"status": "ok"}
-    mock_exists_event_id.assert_called_once_with("duplicate_event")
-    mock_add_event_id.assert_not_called()
+async def test_auth_callback_missing_code(api_mocks):
+    """Test /auth/callback with missing code."""
+    response = await call("GET", "/auth/callback?state=user123|channel456|")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"] == "Authorization code or state missing"
 
 
 @pytest.mark.asyncio
-async def test_slack_events_url_verification(test_client):
-    """Test /slack/events endpoint with url_verification event."""
-    payload = {
-        "type": "url_verification",
-        "challenge": "test_challenge",
-    }
-    response = await test_client.post("/slack/events", json=payload)
+@pytest.mark.parametrize(
+    "state, thread_ts",
+    [
+        ("user123%7Cchannel456%7C1234567890.123456", "1234567890.123456"),
+        ("user123%7Cchannel456%7C", None),
+    ],
+    ids=["in-thread", "no-thread"],
+)
+@patch("example_agents_project.api.cache.set_user_token", new_callable=AsyncMock)
+@patch("example_agents_project.api.store_user_credentials", new_callable=AsyncMock)
+@patch("example_agents_project.api.get_access_token", new_callable=AsyncMock)
+async def test_auth_callback(
+    mock_get_access_token,
+    mock_store,
+    mock_cache_set,
+    api_mocks,
+    state,
+    thread_ts,
+):
+    """Test /auth/callback stores the tokens and replies where `auth` was sent."""
+    response = await call("GET", f"/auth/callback?code=abc&state={state}")
+
     assert response.status_code == status.HTTP_200_OK
-    assert response.json()["challenge"] == "test_challenge"
+    mock_get_access_token.assert_called_once_with("abc")
+    mock_store.assert_called_once_with("user123", mock_get_access_token.return_value)
+    mock_cache_set.assert_called_once_with("user123", mock_store.return_value)
+    api_mocks.send_slack_message.assert_called_once_with(
+        AUTH_SUCCESS, "channel456", thread_ts
+    )
+
+
+@pytest.mark.parametrize(
+    "text, command",
+    [
+        ("hello", "hello"),
+        ("Hello!", "hello"),
+        ("chat: Hello there!", "chat"),
+        ("CHAT:hi", "chat"),
+        ("  status please", "status"),
+        ("", ""),
+        (None, ""),
+    ],
+)
+def test_parse_command(text, command):
+    """Test the command word is taken from the start of a message."""
+    assert parse_command(text) == command
 
 
 @pytest.mark.asyncio
-async def test_auth_callback_missing_code(test_client):
-    """Test /auth/callback with missing code."""
-    response = await test_client.get("/auth/callback?state=user123,channel456,None")
-    assert response.status_code == status.HTTP_400_BAD_REQUEST
-    assert response.json()["detail"] == "Authorization code or state missing"
+@patch("example_agents_project.api.close_db")
+@patch("example_agents_project.api.close_checkpointer")
+@patch("example_agents_project.api.http")
+@patch("example_agents_project.api.cache")
+@patch("example_agents_project.api.init_checkpointer")
+@patch("example_agents_project.api.init_db")
+async def test_lifespan(
+    mock_init_db,
+    mock_init_checkpointer,
+    mock_cache,
+    mock_http,
+    mock_close_checkpointer,
+    mock_close_db,
+):
+    """Test lifespan opens and closes every client, database first."""
+    calls = MagicMock()
+    calls.attach_mock(mock_init_db, "init_db")
+    calls.attach_mock(mock_init_checkpointer, "init_checkpointer")
+    mock_cache.init_client = AsyncMock()
+    mock_cache.close_client = AsyncMock()
+    mock_http.init_client = AsyncMock()
+    mock_http.close_client = AsyncMock()
+
+    async with lifespan(app):
+        assert [name for name, *_ in calls.mock_calls] == [
+            "init_db",
+            "init_checkpointer",
+        ]
+        mock_cache.init_client.assert_called_once()
+        mock_http.init_client.assert_called_once()
+
+    mock_http.close_client.assert_called_once()
+    mock_cache.close_client.assert_called_once()
+    mock_close_checkpointer.assert_called_once()
+    mock_close_db.assert_called_once()
@@ -1,118 +1,450 @@
-import pytest
 import asyncio
-from unittest.mock import AsyncMock, patch
+import pytest
+import pytest_asyncio
+import json
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
 from example_agents_project.cache import (
+    PROCESS_ID,
+    RELEASE_LOCK_SCRIPT,
+    SET_USER_TOKEN_SCRIPT,
+    _handle_invalidation,
     init_client,
     close_client,
+    start_invalidation_listener,
     add_event_id,
     exists_event_id,
+    claim_event_id,
     delete_event_id,
     exists_user_token,
+    exists_user_tokens,
+    fill_user_token,
     set_user_token,
+    get_user_token,
     remove_user_token,
+    get_user_auth_state,
+    set_user_auth_state,
+    fill_user_auth_state,
     acquire_lock,
     release_lock,
 )
 
+from .helpers import FastAsyncMock
 
-@pytest.fixture
-def mock_redis():
-    mock_redis_instance = AsyncMock()
-    mock_redis_instance.initialize = AsyncMock()
-    mock_redis_instance.close = AsyncMock()
-    mock_redis_instance.connection_pool = AsyncMock()
-    mock_redis_instance.connection_pool.disconnect = AsyncMock()
-    mock_redis_instance.set = AsyncMock()
-    mock_redis_instance.get = AsyncMock()
-    mock_redis_instance.delete = AsyncMock()
-    mock_redis_instance.sismember = AsyncMock()
-    mock_redis_instance.sadd = AsyncMock()
-    mock_redis_instance.srem = AsyncMock()
-
-    with patch("example_agents_project.cache.Redis", return_value=mock_redis_instance):
+
+@pytest_asyncio.fixture
+async def mock_redis():
+    """Patched Redis client, already set up through init_client."""
+    mock_redis_instance = MagicMock()
+    # Awaited client methods; FastAsyncMock skips AsyncMock's per-call overhead
+    for name in ("initialize", "close", "set", "get", "delete", "exists"):
+        setattr(mock_redis_instance, name, FastAsyncMock())
+    mock_redis_instance.blpop = FastAsyncMock()
+    mock_redis_instance.connection_pool.disconnect = FastAsyncMock()
+    # One mock per registered Lua script, keyed by its source
+    mock_redis_instance.scripts = {}
+    mock_redis_instance.register_script = MagicMock(
+        side_effect=lambda script: mock_redis_instance.scripts.setdefault(
+            script, FastAsyncMock()
+        )
+    )
+
+    mock_pipe = MagicMock()
+    mock_pipe.__aenter__.return_value = mock_pipe
+    mock_pipe.execute = FastAsyncMock()
+    mock_redis_instance.pipeline = MagicMock(return_value=mock_pipe)
+
+    with patch(
+        "example_agents_project.cache.BlockingConnectionPool"
+    ) as mock_pool, patch(
+        "example_agents_project.cache.Redis", return_value=mock_redis_instance
+    ):
+        mock_redis_instance.pool_class = mock_pool
+        await init_client()
         yield mock_redis_instance
 
 
+@pytest.fixture
+def mock_pipe(mock_redis):
+    return mock_redis.pipeline.return_value
+
+
 @pytest.mark.asyncio
 async def test_init_client(mock_redis):
-    await init_client()
+    mock_redis.pool_class.assert_called_once()
+    assert mock_redis.pool_class.call_args.kwargs["health_check_interval"] == 30
     mock_redis.initialize.assert_called_once()
 
 
 @pytest.mark.asyncio
 async def test_close_client(mock_redis):
-    await init_client()
     await close_client()
     mock_redis.close.assert_called_once()
     mock_redis.connection_pool.disconnect.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_close_client_awaits_listener(mock_redis):
+    events = []
+
+    async def listen():
+        try:
+            await asyncio.sleep(3600)
+        finally:
+            events.append("listener stopped")
+
+    mock_redis.close.side_effect = lambda: events.append("client closed")
+    with patch("example_agents_project.cache._listen_for_invalidations", listen):
+        start_invalidation_listener()
+        await asyncio.sleep(0)
+        await close_client()
+
+    assert events == ["listener stopped", "client closed"]
+
+
 @pytest.mark.asyncio
 async def test_add_event_id(mock_redis):
-    await init_client()
     await add_event_id("test_event")
     mock_redis.set.assert_called_once_with("event:test_event", "test_event", ex=3600)
 
 
 @pytest.mark.asyncio
 async def test_exists_event_id(mock_redis):
-    await init_client()
-    mock_redis.get.return_value = "test_event"
+    mock_redis.exists.return_value = 1
     exists = await exists_event_id("test_event")
     assert exists is True
-    mock_redis.get.assert_called_once_with("event:test_event")
+    mock_redis.exists.assert_called_once_with("event:test_event")
+    mock_redis.get.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_exists_event_id_not_found(mock_redis):
-    await init_client()
-    mock_redis.get.return_value = None
+    mock_redis.exists.return_value = 0
     exists = await exists_event_id("test_event")
     assert exists is False
-    mock_redis.get.assert_called_once_with("event:test_event")
+    mock_redis.exists.assert_called_once_with("event:test_event")
+
+
+@pytest.mark.asyncio
+async def test_claim_event_id(mock_redis):
+    mock_redis.set.return_value = True
+    claimed = await claim_event_id("test_event")
+    assert claimed is True
+    mock_redis.set.assert_called_once_with("event:test_event", 1, ex=3600, nx=True)
+
+
+@pytest.mark.asyncio
+async def test_claim_event_id_duplicate(mock_redis):
+    mock_redis.set.return_value = None
+    claimed = await claim_event_id("test_event")
+    assert claimed is False
+
+
+@pytest.mark.asyncio
+async def test_claim_event_id_local_hit(mock_redis):
+    mock_redis.set.return_value = True
+    assert await claim_event_id("test_event") is True
+
+    # The retry is caught in-process, without a Redis round trip
+    assert await claim_event_id("test_event") is False
+    assert await exists_event_id("test_event") is True
+    mock_redis.set.assert_called_once()
+    mock_redis.exists.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_delete_event_id_drops_local(mock_redis):
+    await add_event_id("test_event")
+    await delete_event_id("test_event")
+
+    mock_redis.exists.return_value = 0
+    assert await exists_event_id("test_event") is False
+    mock_redis.exists.assert_called_once_with("event:test_event")
 
 
 @pytest.mark.asyncio
 async def test_delete_event_id(mock_redis):
-    await init_client()
     await delete_event_id("test_event")
     mock_redis.delete.assert_called_once_with("event:test_event")
 
 
 @pytest.mark.asyncio
 async def test_exists_user_token(mock_redis):
-    await init_client()
-    mock_redis.sismember.return_value = 1
+    mock_redis.exists.return_value = 1
     exists = await exists_user_token("test_user")
     assert exists is True
-    mock_redis.sismember.assert_called_once_with("tokens", "test_user")
+    mock_redis.exists.assert_called_once_with("user:test_user")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "results, expected",
+    [([1, 0, 1], [True, False, True]), ([], [])],
+)
+async def test_exists_user_tokens(mock_redis, mock_pipe, results, expected):
+    mock_pipe.execute.return_value = results
+    user_ids = [f"user{i}" for i in range(len(results))]
+    assert await exists_user_tokens(user_ids) == expected
+    assert [c.args for c in mock_pipe.exists.call_args_list] == [
+        (f"user:{user_id}",) for user_id in user_ids
+    ]
+    mock_pipe.execute.assert_called_once()
+    mock_redis.exists.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_set_user_token(mock_redis):
-    await init_client()
-    await set_user_token("test_user", {})
-    mock_redis.sadd.assert_called_once_with("tokens", "test_user")
+    expires_at = datetime.now() + timedelta(hours=1)
+    tokens = {
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_at": expires_at,
+        "scopes": ["scope"],
+    }
+    await set_user_token("test_user", tokens)
+
+    script = mock_redis.scripts[SET_USER_TOKEN_SCRIPT]
+    script.assert_called_once()
+    assert script.call_args.kwargs["keys"] == ["user:test_user", "auth:test_user"]
+    value, ttl, auth_ttl, channel, message = script.call_args.kwargs["args"]
+    assert json.loads(value)["expires_at"] == expires_at.isoformat()
+    assert 3590 < ttl <= 3600
+    assert (auth_ttl, channel) == (3600, "invalidations")
+    assert message == f"{PROCESS_ID}:test_user"
+    mock_redis.set.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_set_user_token_expired(mock_redis):
+    tokens = {
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_at": datetime.now() - timedelta(hours=1),
+        "scopes": ["scope"],
+    }
+    await set_user_token("test_user", tokens)
+
+    # The script skips the token SET for a non-positive TTL
+    _, ttl, *_ = mock_redis.scripts[SET_USER_TOKEN_SCRIPT].call_args.kwargs["args"]
+    assert ttl <= 0
+
+
+@pytest.mark.asyncio
+async def test_fill_user_token(mock_redis, mock_pipe):
+    tokens = {
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_at": datetime.now() + timedelta(hours=1),
+        "scopes": ["scope"],
+    }
+    mock_pipe.execute.return_value = [True, True]
+    await fill_user_token("test_user", tokens)
+
+    assert [c.args[0] for c in mock_pipe.set.call_args_list] == [
+        "user:test_user",
+        "auth:test_user",
+    ]
+    assert all(c.kwargs["nx"] for c in mock_pipe.set.call_args_list)
+    mock_pipe.publish.assert_not_called()
+    mock_pipe.execute.assert_called_once()
+    assert await get_user_token("test_user") == tokens
+    mock_redis.get.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_fill_user_token_existing(mock_redis, mock_pipe):
+    tokens = {
+        "access_token": "stale_token",
+        "refresh_token": "refresh",
+        "expires_at": datetime.now() + timedelta(hours=1),
+        "scopes": ["scope"],
+    }
+    # A real write landed first, so NX skips both keys
+    mock_pipe.execute.return_value = [None, None]
+    await fill_user_token("test_user", tokens)
+
+    mock_redis.get.return_value = None
+    assert await get_user_token("test_user") is None
+    mock_redis.get.assert_called_once_with("user:test_user")
+
+
+@pytest.mark.asyncio
+async def test_get_user_token(mock_redis):
+    expires_at = datetime.now() + timedelta(hours=1)
+    mock_redis.get.return_value = json.dumps(
+        {
+            "access_token": "token",
+            "refresh_token": "refresh",
+            "expires_at": expires_at.isoformat(),
+            "scopes": ["scope"],
+        }
+    )
+    tokens = await get_user_token("test_user")
+    assert tokens["access_token"] == "token"
+    assert tokens["expires_at"] == expires_at
+    mock_redis.get.assert_called_once_with("user:test_user")
 
 
 @pytest.mark.asyncio
-async def test_remove_user_token(mock_redis):
-    await init_client()
+async def test_get_user_token_not_cached(mock_redis):
+    mock_redis.get.return_value = None
+    tokens = await get_user_token("test_user")
+    assert tokens is None
+
+
+@pytest.mark.asyncio
+async def test_remove_user_token(mock_redis, mock_pipe):
+    await remove_user_token("test_user")
+    mock_pipe.delete.assert_called_once_with("user:test_user", "auth:test_user")
+    mock_pipe.publish.assert_called_once_with(
+        "invalidations", f"{PROCESS_ID}:test_user"
+    )
+    mock_pipe.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_get_user_token_local_hit(mock_redis):
+    tokens = {
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_at": datetime.now() + timedelta(hours=1),
+        "scopes": ["scope"],
+    }
+    await set_user_token("test_user", tokens)
+
+    assert await get_user_token("test_user") == tokens
+    mock_redis.get.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_own_invalidation_keeps_local(mock_redis):
+    await set_user_auth_state("test_user", True)
+
+    # Redis echoes our own publish back to our subscription
+    _handle_invalidation(f"{PROCESS_ID}:test_user".encode())
+    assert await get_user_auth_state("test_user") is True
+    mock_redis.get.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_other_invalidation_drops_local(mock_redis):
+    await set_user_auth_state("test_user", True)
+
+    _handle_invalidation(b"other_process:test_user")
+    mock_redis.get.return_value = None
+    assert await get_user_auth_state("test_user") is None
+    mock_redis.get.assert_called_once_with("auth:test_user")
+
+
+@pytest.mark.asyncio
+async def test_remove_user_token_drops_local(mock_redis):
+    await set_user_auth_state("test_user", True)
     await remove_user_token("test_user")
-    mock_redis.srem.assert_called_once_with("tokens", "test_user")
+
+    mock_redis.get.return_value = None
+    assert await get_user_auth_state("test_user") is None
+    mock_redis.get.assert_called_once_with("auth:test_user")
+
+
+@pytest.mark.asyncio
+async def test_get_user_auth_state(mock_redis):
+    mock_redis.get.return_value = b"1"
+    state = await get_user_auth_state("test_user")
+    assert state is True
+    mock_redis.get.assert_called_once_with("auth:test_user")
+
+
+@pytest.mark.asyncio
+async def test_get_user_auth_state_negative(mock_redis):
+    mock_redis.get.return_value = b"0"
+    state = await get_user_auth_state("test_user")
+    assert state is False
+
+    # Served locally the second time, negative states included
+    assert await get_user_auth_state("test_user") is False
+    mock_redis.get.assert_called_once_with("auth:test_user")
+
+
+@pytest.mark.asyncio
+async def test_get_user_auth_state_not_cached(mock_redis):
+    mock_redis.get.return_value = None
+    state = await get_user_auth_state("test_user")
+    assert state is None
+
+
+@pytest.mark.asyncio
+async def test_set_user_auth_state(mock_redis, mock_pipe):
+    await set_user_auth_state("test_user", True)
+    mock_pipe.set.assert_called_once_with("auth:test_user", 1, ex=3600)
+    mock_pipe.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_set_user_auth_state_negative(mock_redis, mock_pipe):
+    await set_user_auth_state("test_user", False)
+    mock_pipe.set.assert_called_once_with("auth:test_user", 0, ex=60)
+    mock_pipe.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_fill_user_auth_state(mock_redis, mock_pipe):
+    mock_redis.set.return_value = True
+    await fill_user_auth_state("test_user", False)
+
+    mock_redis.set.assert_called_once_with("auth:test_user", 0, ex=60, nx=True)
+    mock_pipe.publish.assert_not_called()
+    assert await get_user_auth_state("test_user") is False
+    mock_redis.get.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_fill_user_auth_state_keeps_tokens(mock_redis):
+    tokens = {
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_at": datetime.now() + timedelta(hours=1),
+        "scopes": ["scope"],
+    }
+    await set_user_token("test_user", tokens)
+    mock_redis.set.return_value = None  # auth key already present
+    await fill_user_auth_state("test_user", True)
+
+    # Neither the local token entry nor the auth entry was dropped
+    assert await get_user_token("test_user") == tokens
+    assert await get_user_auth_state("test_user") is True
+    mock_redis.get.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_acquire_lock(mock_redis):
-    await init_client()
     mock_redis.set.return_value = True
-    acquired = await acquire_lock("test_user")
-    assert acquired is True
-    mock_redis.set.assert_called_with("lock:test_user", "true", ex=3600, nx=True)
+    token = await acquire_lock("test_user")
+    assert token
+    mock_redis.set.assert_called_with("lock:test_user", token, ex=3600, nx=True)
+    mock_redis.blpop.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_acquire_lock_waits_for_release(mock_redis):
+    mock_redis.set.side_effect = [None, True]
+    token = await acquire_lock("test_user")
+    assert token
+    assert mock_redis.set.call_count == 2
+    mock_redis.blpop.assert_called_once()
+    assert mock_redis.blpop.call_args.args[0] == ["lock_wait:test_user"]
+
+
+@pytest.mark.asyncio
+async def test_acquire_lock_timeout(mock_redis):
+    mock_redis.set.return_value = None
+    token = await acquire_lock("test_user", timeout_secs=0)
+    assert token is None
+    mock_redis.blpop.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_release_lock(mock_redis):
-    await init_client()
-    await release_lock("test_user")
-    mock_redis.delete.assert_called_once_with("lock:test_user")
+    await release_lock("test_user", "token")
+    mock_redis.scripts[RELEASE_LOCK_SCRIPT].assert_called_once_with(
+        keys=["lock:test_user", "lock_wait:test_user"], args=["token"]
+    )
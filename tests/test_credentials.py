@@ -1,17 +1,21 @@
+import orjson
 import pytest
 from unittest.mock import AsyncMock, patch, MagicMock
 from datetime import datetime, timedelta
 from fastapi import HTTPException
 from google.oauth2.credentials import Credentials
 
+from example_agents_project.db import NoCredentialsFound
 from example_agents_project.credentials import (
     store_user_credentials,
     has_user_credentials,
+    resolve_auth,
     get_user_credentials,
     get_auth_url,
     get_access_token,
     refresh_access_token,
     revoke_credentials,
+    _refresh_in_background,
 )
 
 
@@ -33,8 +37,51 @@ async def test_has_user_credentials(mock_has):
 
 
 @pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.fill_user_auth_state",
+    new_callable=AsyncMock,
+)
+@patch(
+    "example_agents_project.credentials.cache.get_user_auth_state",
+    new_callable=AsyncMock,
+)
+@patch("example_agents_project.credentials.has_user_token", new_callable=AsyncMock)
+async def test_resolve_auth_cached(mock_has, mock_get_state, mock_fill_state):
+    mock_get_state.return_value = True
+    result = await resolve_auth("test_user")
+    assert result is True
+    mock_has.assert_not_called()
+    mock_fill_state.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.fill_user_auth_state",
+    new_callable=AsyncMock,
+)
+@patch(
+    "example_agents_project.credentials.cache.get_user_auth_state",
+    new_callable=AsyncMock,
+)
+@patch("example_agents_project.credentials.has_user_token", new_callable=AsyncMock)
+async def test_resolve_auth_not_cached(mock_has, mock_get_state, mock_fill_state):
+    mock_get_state.return_value = None
+    mock_has.return_value = False
+    result = await resolve_auth("test_user")
+    assert result is False
+    mock_has.assert_called_once_with("test_user")
+    mock_fill_state.assert_called_once_with("test_user", False)
+
+
+@pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.fill_user_token", new_callable=AsyncMock
+)
+@patch(
+    "example_agents_project.credentials.cache.get_user_token", return_value=None
+)
 @patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
-async def test_get_user_credentials_valid(mock_get):
+async def test_get_user_credentials_valid(mock_get, mock_cache_get, mock_cache_fill):
     future_time = datetime.now() + timedelta(hours=1)
     mock_get.return_value = {
         "access_token": "test_token",
@@ -47,44 +94,107 @@ async def test_get_user_credentials_valid(mock_get):
     assert isinstance(result, Credentials)
     assert result.token == "test_token"
     mock_get.assert_called_once_with("test_user")
+    mock_cache_get.assert_called_once_with("test_user")
+    mock_cache_fill.assert_called_once_with("test_user", mock_get.return_value)
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.credentials.cache.get_user_token")
+@patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
+async def test_get_user_credentials_cached(mock_get, mock_cache_get):
+    future_time = datetime.now() + timedelta(hours=1)
+    mock_cache_get.return_value = {
+        "access_token": "cached_token",
+        "refresh_token": "test_refresh",
+        "expires_at": future_time,
+        "scopes": ["test_scope"],
+    }
+
+    result = await get_user_credentials("test_user")
+    assert isinstance(result, Credentials)
+    assert result.token == "cached_token"
+    mock_get.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.credentials.schedule_refresh")
+@patch("example_agents_project.credentials.cache.get_user_token")
+async def test_get_user_credentials_stale(mock_cache_get, mock_schedule):
+    mock_cache_get.return_value = {
+        "access_token": "cached_token",
+        "refresh_token": "test_refresh",
+        "expires_at": datetime.now() + timedelta(minutes=1),
+        "scopes": ["test_scope"],
+    }
+
+    # Still valid, so served now while the refresh runs in the background
+    result = await get_user_credentials("test_user")
+    assert result.token == "cached_token"
+    mock_schedule.assert_called_once_with("test_user", "test_refresh")
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.credentials.cache.release_lock", new_callable=AsyncMock)
+@patch("example_agents_project.credentials.cache.acquire_lock", new_callable=AsyncMock)
+@patch(
+    "example_agents_project.credentials.refresh_access_token", new_callable=AsyncMock
+)
+async def test_refresh_in_background(mock_refresh, mock_acquire, mock_release):
+    mock_acquire.return_value = "lock_token"
+
+    await _refresh_in_background("test_user", "test_refresh")
+    mock_acquire.assert_called_once_with("refresh:test_user", timeout_secs=0)
+    mock_refresh.assert_called_once_with("test_user", "test_refresh")
+    mock_release.assert_called_once_with("refresh:test_user", "lock_token")
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.credentials.cache.release_lock", new_callable=AsyncMock)
+@patch("example_agents_project.credentials.cache.acquire_lock", new_callable=AsyncMock)
+@patch(
+    "example_agents_project.credentials.refresh_access_token", new_callable=AsyncMock
+)
+async def test_refresh_in_background_already_running(
+    mock_refresh, mock_acquire, mock_release
+):
+    mock_acquire.return_value = None
+
+    await _refresh_in_background("test_user", "test_refresh")
+    mock_refresh.assert_not_called()
+    mock_release.assert_not_called()
 
 
 @pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.get_user_token", return_value=None
+)
 @patch(
     "example_agents_project.credentials.refresh_access_token", new_callable=AsyncMock
 )
 @patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
-async def test_get_user_credentials_expired(mock_get, mock_refresh):
+async def test_get_user_credentials_expired(mock_get, mock_refresh, mock_cache_get):
     past_time = datetime.now() - timedelta(hours=1)
     future_time = datetime.now() + timedelta(hours=1)
 
-    # First call returns expired token, second call returns refreshed token
-    mock_get.side_effect = [
-        {
-            "access_token": "old_token",
-            "refresh_token": "test_refresh",
-            "expires_at": past_time,
-            "scopes": ["test_scope"],
-        },
-        {
-            "access_token": "new_token",
-            "refresh_token": "test_refresh",
-            "expires_at": future_time,
-            "scopes": ["test_scope"],
-        },
-    ]
+    mock_get.return_value = {
+        "access_token": "old_token",
+        "refresh_token": "test_refresh",
+        "expires_at": past_time,
+        "scopes": ["test_scope"],
+    }
 
-    # Mock the refresh token call
+    # The refresh returns the stored tokens, so they aren't read back
     mock_refresh.return_value = {
         "access_token": "new_token",
         "refresh_token": "test_refresh",
-        "expires_in": 3600,
+        "expires_at": future_time,
+        "scopes": ["test_scope"],
     }
 
     result = await get_user_credentials("test_user")
     assert isinstance(result, Credentials)
     assert result.token == "new_token"
-    assert mock_get.call_count == 2
+    mock_get.assert_called_once_with("test_user")
     mock_refresh.assert_called_once_with("test_user", "test_refresh")
 
 
@@ -93,20 +203,28 @@ def test_get_auth_url():
     assert "accounts.google.com" in url
     assert "client_id=" in url
     assert "redirect_uri=" in url
-    assert "test_user,test_channel,test_thread" in url
+    assert " " not in url
+    assert "state=test_user%7Ctest_channel%7Ctest_thread" in url
+
+
+def test_get_auth_url_without_thread():
+    url = get_auth_url("test_user", "test_channel", None)
+    assert url.endswith("state=test_user%7Ctest_channel%7C")
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.credentials.httpx.AsyncClient")
+@patch("example_agents_project.credentials.http.get_client")
 async def test_get_access_token_success(mock_client):
     mock_response = MagicMock()
     mock_response.status_code = 200
-    mock_response.json.return_value = {
-        "access_token": "new_token",
-        "refresh_token": "refresh_token",
-        "expires_in": 3600,
-    }
-    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    mock_response.content = orjson.dumps(
+        {
+            "access_token": "new_token",
+            "refresh_token": "refresh_token",
+            "expires_in": 3600,
+        }
+    )
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
 
     result = await get_access_token("test_code")
     assert result == {
@@ -114,15 +232,20 @@ async def test_get_access_token_success(mock_client):
         "refresh_token": "refresh_token",
         "expires_in": 3600,
     }
+    mock_client.return_value.post.assert_called_once()
+    assert (
+        mock_client.return_value.post.call_args.args[0]
+        == "https://oauth2.googleapis.com/token"
+    )
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.credentials.httpx.AsyncClient")
+@patch("example_agents_project.credentials.http.get_client")
 async def test_get_access_token_failure(mock_client):
     mock_response = MagicMock()
     mock_response.status_code = 400
-    mock_response.json.return_value = {"error": "invalid_grant"}
-    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    mock_response.content = orjson.dumps({"error": "invalid_grant"})
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
 
     with pytest.raises(HTTPException):
         await get_access_token("invalid_code")
@@ -133,44 +256,48 @@ async def test_get_access_token_failure(mock_client):
     "example_agents_project.credentials.cache.set_user_token", new_callable=AsyncMock
 )
 @patch("example_agents_project.credentials.update_user_token", new_callable=AsyncMock)
-@patch("example_agents_project.credentials.httpx.AsyncClient")
+@patch("example_agents_project.credentials.http.get_client")
 async def test_refresh_access_token_success(mock_client, mock_update, mock_cache):
     mock_response = MagicMock()
     mock_response.status_code = 200
-    mock_response.json.return_value = {
-        "access_token": "new_token",
-        "refresh_token": "refresh_token",
-        "expires_in": 3600,
-    }
-    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    mock_response.content = orjson.dumps(
+        {
+            "access_token": "new_token",
+            "refresh_token": "refresh_token",
+            "expires_in": 3600,
+        }
+    )
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
 
     result = await refresh_access_token("test_user", "test_refresh_token")
-    assert result == {
-        "access_token": "new_token",
-        "refresh_token": "refresh_token",
-        "expires_in": 3600,
-    }
+    assert result is mock_update.return_value
     mock_update.assert_called_once()
-    mock_cache.assert_called_once()
+    mock_cache.assert_called_once_with("test_user", mock_update.return_value)
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.credentials.httpx.AsyncClient")
+@patch("example_agents_project.credentials.http.get_client")
 async def test_refresh_access_token_failure(mock_client):
     mock_response = MagicMock()
     mock_response.status_code = 400
-    mock_response.json.return_value = {"error": "invalid_grant"}
-    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    mock_response.content = orjson.dumps({"error": "invalid_grant"})
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
 
     with pytest.raises(HTTPException):
         await refresh_access_token("test_user", "invalid_refresh_token")
 
 
 @pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.remove_user_token",
+    new_callable=AsyncMock,
+)
 @patch("example_agents_project.credentials.delete_user_token", new_callable=AsyncMock)
 @patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
-@patch("example_agents_project.credentials.httpx.AsyncClient")
-async def test_revoke_credentials_success(mock_client, mock_get, mock_delete):
+@patch("example_agents_project.credentials.http.get_client")
+async def test_revoke_credentials_success(
+    mock_client, mock_get, mock_delete, mock_cache_remove
+):
     future_time = datetime.now() + timedelta(hours=1)
     mock_get.return_value = {
         "access_token": "test_token",
@@ -180,16 +307,80 @@ async def test_revoke_credentials_success(mock_client, mock_get, mock_delete):
 
     mock_response = MagicMock()
     mock_response.status_code = 200
-    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
+
+    result = await revoke_credentials("test_user")
+    assert result is True
+    mock_delete.assert_called_once_with("test_user")
+    mock_cache_remove.assert_called_once_with("test_user")
+
+
+@pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.remove_user_token",
+    new_callable=AsyncMock,
+)
+@patch("example_agents_project.credentials.delete_user_token", new_callable=AsyncMock)
+@patch(
+    "example_agents_project.credentials.refresh_access_token", new_callable=AsyncMock
+)
+@patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
+@patch("example_agents_project.credentials.http.get_client")
+async def test_revoke_credentials_expired(
+    mock_client, mock_get, mock_refresh, mock_delete, mock_cache_remove
+):
+    past_time = datetime.now() - timedelta(hours=1)
+    mock_get.return_value = {
+        "access_token": "old_token",
+        "refresh_token": "test_refresh",
+        "expires_at": past_time,
+    }
+    mock_refresh.return_value = {
+        "access_token": "new_token",
+        "refresh_token": "test_refresh",
+        "expires_at": datetime.now() + timedelta(hours=1),
+    }
+
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
 
-    await revoke_credentials("test_user")
+    result = await revoke_credentials("test_user")
+    assert result is True
+    mock_get.assert_called_once_with("test_user")
+    mock_refresh.assert_called_once_with("test_user", "test_refresh")
+    assert mock_client.return_value.post.call_args.kwargs["data"] == {
+        "token": "new_token"
+    }
     mock_delete.assert_called_once_with("test_user")
 
 
 @pytest.mark.asyncio
+@patch(
+    "example_agents_project.credentials.cache.remove_user_token",
+    new_callable=AsyncMock,
+)
+@patch("example_agents_project.credentials.delete_user_token", new_callable=AsyncMock)
+@patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
+@patch("example_agents_project.credentials.http.get_client")
+async def test_revoke_credentials_not_found(
+    mock_client, mock_get, mock_delete, mock_cache_remove
+):
+    mock_get.side_effect = NoCredentialsFound("Tokens not found")
+
+    result = await revoke_credentials("test_user")
+    assert result is False
+    mock_client.return_value.post.assert_not_called()
+    mock_delete.assert_not_called()
+    # Stale cache entries are still cleared, so `auth` works again
+    mock_cache_remove.assert_called_once_with("test_user")
+
+
+@pytest.mark.asyncio
+@patch("example_agents_project.credentials.delete_user_token", new_callable=AsyncMock)
 @patch("example_agents_project.credentials.get_user_token", new_callable=AsyncMock)
-@patch("example_agents_project.credentials.httpx.AsyncClient")
-async def test_revoke_credentials_failure(mock_client, mock_get):
+@patch("example_agents_project.credentials.http.get_client")
+async def test_revoke_credentials_failure(mock_client, mock_get, mock_delete):
     future_time = datetime.now() + timedelta(hours=1)
     mock_get.return_value = {
         "access_token": "test_token",
@@ -199,7 +390,10 @@ async def test_revoke_credentials_failure(mock_client, mock_get):
 
     mock_response = MagicMock()
     mock_response.status_code = 400
-    mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+    mock_client.return_value.post = AsyncMock(return_value=mock_response)
 
     with pytest.raises(HTTPException):
         await revoke_credentials("test_user")
+
+    # Tokens are kept when Google refuses the revoke
+    mock_delete.assert_not_called()
@@ -1,27 +1,60 @@
 import pytest
-from unittest.mock import AsyncMock, patch
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
 from example_agents_project.db import (
     create_database_if_not_exists,
     init_db,
+    close_db,
     store_user_token,
+    bulk_store_user_tokens,
     update_user_token,
     has_user_token,
     get_user_token,
     delete_user_token,
-    UserToken,
+    NoCredentialsFound,
     DB_NAME,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    POOL_DSN,
     QUERY_DBS,
+    QUERY_UPSERT_TOKEN,
+    QUERY_UPDATE_TOKEN,
+    QUERY_HAS_TOKEN,
+    QUERY_GET_TOKEN,
+    QUERY_DELETE_TOKEN,
+    TOKEN_COLUMNS,
 )
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.sql import text
+
+
+@pytest.fixture
+def mock_pool():
+    mock_pool_instance = MagicMock()
+    mock_pool_instance.close = AsyncMock()
+    mock_pool_instance.acquire.return_value.__aenter__.return_value = AsyncMock()
+
+    with patch("example_agents_project.db._pool", mock_pool_instance):
+        yield mock_pool_instance
+
+
+@pytest.fixture
+def mock_conn(mock_pool):
+    return mock_pool.acquire.return_value.__aenter__.return_value
+
+
+def _row(**overrides):
+    row = {
+        "access_token": "token",
+        "refresh_token": "refresh",
+        "expires_at": datetime(2025, 1, 1),
+        "scopes": "scope",
+    }
+    row.update(overrides)
+    return row
 
 
 @pytest.mark.asyncio
 @patch("example_agents_project.db.create_async_engine")
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_create_database_if_not_exists(
-    mock_async_session_local, mock_create_async_engine
-):
+async def test_create_database_if_not_exists(mock_create_async_engine):
     """Test database creation if it does not exist."""
     mock_conn = AsyncMock()
     mock_result = AsyncMock()
@@ -41,22 +74,31 @@ async def test_create_database_if_not_exists(
 
 
 @pytest.mark.asyncio
+@patch("example_agents_project.db.asyncpg.create_pool", new_callable=AsyncMock)
+@patch("example_agents_project.db.async_engine")
 @patch("example_agents_project.db.create_database_if_not_exists")
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_init_db(mock_async_session_local, mock_create_database_if_not_exists):
+async def test_init_db(
+    mock_create_database_if_not_exists, mock_async_engine, mock_create_pool
+):
     """Test database initialization."""
+    mock_async_engine.begin.return_value.__aenter__.return_value = AsyncMock()
+
     await init_db()
     mock_create_database_if_not_exists.assert_called_once()
+    mock_create_pool.assert_called_once_with(
+        POOL_DSN, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE
+    )
+
+    await close_db()
+    mock_create_pool.return_value.close.assert_called_once()
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_store_user_token(mock_async_session_local):
+async def test_store_user_token(mock_conn):
     """Test storing a user token."""
-    mock_session = AsyncMock()
-    mock_session.add = AsyncMock()
-    mock_session.commit = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
+    mock_conn.fetchrow.return_value = _row(
+        access_token="access_token_value", scopes="scope_value"
+    )
 
     user_id = "user123"
     data = {
@@ -66,25 +108,38 @@ async def test_store_user_token(mock_async_session_local):
         "scope": "scope_value",
     }
 
-    await store_user_token(user_id, data)
+    result = await store_user_token(user_id, data)
+
+    mock_conn.fetchrow.assert_called_once()
+    query, *args = mock_conn.fetchrow.call_args.args
+    assert query == QUERY_UPSERT_TOKEN
+    assert args[:3] == [user_id, data["access_token"], data["refresh_token"]]
+    assert args[4] == data["scope"]
+    assert result["access_token"] == data["access_token"]
+    assert result["scopes"] == ["scope_value"]
 
-    # Get the UserToken object that was passed to add
-    token = mock_session.add.call_args[0][0]
-    assert isinstance(token, UserToken)
-    assert token.user_id == user_id
-    assert token.access_token == data["access_token"]
-    mock_session.add.assert_called_once()
-    mock_session.commit.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_bulk_store_user_tokens(mock_conn):
+    """Test storing many user tokens with a single COPY."""
+    rows = [
+        (f"user{i}", "token", "refresh", datetime(2025, 1, 1), "scope")
+        for i in range(1000)
+    ]
+
+    await bulk_store_user_tokens(rows)
+
+    mock_conn.copy_records_to_table.assert_called_once_with(
+        "user_tokens", records=rows, columns=TOKEN_COLUMNS
+    )
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_update_user_token(mock_async_session_local):
+async def test_update_user_token(mock_conn):
     """Test updating a user token."""
-    mock_session = AsyncMock()
-    mock_session.get = AsyncMock()
-    mock_session.commit = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
+    mock_conn.fetchrow.return_value = _row(
+        access_token="new_access_token", scopes="new_scope"
+    )
 
     user_id = "user123"
     data = {
@@ -93,129 +148,84 @@ async def test_update_user_token(mock_async_session_local):
         "scope": "new_scope",
     }
 
-    mock_token = UserToken(
-        user_id=user_id,
-        access_token="old_token",
-        refresh_token="old_refresh",
-        expires_at=None,
-        scopes="old_scope",
-    )
-    mock_session.get.return_value = mock_token
+    result = await update_user_token(user_id, data)
+
+    mock_conn.fetchrow.assert_called_once()
+    query, *args = mock_conn.fetchrow.call_args.args
+    assert query == QUERY_UPDATE_TOKEN
+    assert args[:2] == [user_id, data["access_token"]]
+    assert args[3] == data["scope"]
+    assert result["access_token"] == data["access_token"]
+    assert result["refresh_token"] == "refresh"
 
-    await update_user_token(user_id, data)
 
-    mock_session.get.assert_called_once()
-    mock_session.commit.assert_called_once()
-    assert mock_token.access_token == data["access_token"]
-    assert mock_token.scopes == data["scope"]
+@pytest.mark.asyncio
+async def test_update_user_token_not_found(mock_conn):
+    """Test updating a user token that does not exist."""
+    mock_conn.fetchrow.return_value = None
+
+    data = {"access_token": "new_access_token", "expires_in": 3600, "scope": "s"}
+    with pytest.raises(NoCredentialsFound):
+        await update_user_token("user123", data)
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_has_user_token(mock_async_session_local):
+async def test_has_user_token(mock_conn):
     """Test checking if a user token exists."""
-    mock_session = AsyncMock()
-    mock_session.get = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
+    mock_conn.fetchval.return_value = True
 
-    user_id = "user123"
-    mock_token = UserToken(
-        user_id=user_id,
-        access_token="token",
-        refresh_token="refresh",
-        expires_at=None,
-        scopes="scope",
-    )
-    mock_session.get.return_value = mock_token
-
-    result = await has_user_token(user_id)
+    result = await has_user_token("user123")
 
-    mock_session.get.assert_called_once()
+    mock_conn.fetchval.assert_called_once_with(QUERY_HAS_TOKEN, "user123")
     assert result is True
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_get_user_token(mock_async_session_local):
+async def test_get_user_token(mock_conn):
     """Test retrieving a user token."""
-    mock_session = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
-
-    user_id = "user123"
-    mock_session.get.return_value = UserToken(
-        user_id=user_id,
-        access_token="token",
-        refresh_token="refresh",
-        expires_at=None,
-        scopes="scope",
-    )
+    mock_conn.fetchrow.return_value = _row()
 
-    result = await get_user_token(user_id)
+    result = await get_user_token("user123")
 
+    mock_conn.fetchrow.assert_called_once_with(QUERY_GET_TOKEN, "user123")
     assert result["access_token"] == "token"
     assert result["scopes"] == ["scope"]
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_delete_user_token(mock_async_session_local):
+async def test_delete_user_token(mock_conn):
     """Test deleting a user token."""
-    mock_session = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
+    mock_conn.execute.return_value = "DELETE 1"
 
-    user_id = "user123"
-    mock_session.get.return_value = UserToken(
-        user_id=user_id,
-        access_token="token",
-        refresh_token="refresh",
-        expires_at=None,
-        scopes="scope",
-    )
+    assert await delete_user_token("user123") is True
 
-    await delete_user_token(user_id)
-
-    mock_session.delete.assert_called_once()
+    mock_conn.execute.assert_called_once_with(QUERY_DELETE_TOKEN, "user123")
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_has_user_token_false(mock_async_session_local):
+async def test_has_user_token_false(mock_conn):
     """Test checking if a user token does not exist."""
-    mock_session = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
-
-    user_id = "user123"
-    mock_session.get.return_value = None  # Simulate token not found
+    mock_conn.fetchval.return_value = False
 
-    result = await has_user_token(user_id)
+    result = await has_user_token("user123")
 
     assert result is False
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_get_user_token_not_found(mock_async_session_local):
+async def test_get_user_token_not_found(mock_conn):
     """Test retrieving a user token that does not exist."""
-    mock_session = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
-
-    user_id = "user123"
-    mock_session.get.return_value = None  # Simulate token not found
+    mock_conn.fetchrow.return_value = None  # Simulate token not found
 
     with pytest.raises(Exception, match="Tokens not found"):
-        await get_user_token(user_id)
+        await get_user_token("user123")
 
 
 @pytest.mark.asyncio
-@patch("example_agents_project.db.AsyncSessionLocal")
-async def test_delete_user_token_not_found(mock_async_session_local):
+async def test_delete_user_token_not_found(mock_conn):
     """Test deleting a user token that does not exist."""
-    mock_session = AsyncMock()
-    mock_async_session_local.return_value.__aenter__.return_value = mock_session
-
-    user_id = "user123"
-    mock_session.get.return_value = None  # Simulate token not found
+    mock_conn.execute.return_value = "DELETE 0"  # Simulate token not found
 
-    await delete_user_token(user_id)
+    assert await delete_user_token("user123") is False
 
-    mock_session.delete.assert_not_called()  # Ensure delete was not called
+    mock_conn.execute.assert_called_once_with(QUERY_DELETE_TOKEN, "user123")
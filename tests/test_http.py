@@ -0,0 +1,33 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+from example_agents_project.http import init_client, get_client, close_client
+
+
+@pytest.fixture
+def mock_httpx_client():
+    mock_client_instance = AsyncMock()
+    mock_client_instance.aclose = AsyncMock()
+
+    with patch(
+        "example_agents_project.http.httpx.AsyncClient",
+        return_value=mock_client_instance,
+    ) as mock_client:
+        yield mock_client
+
+
+@pytest.mark.asyncio
+async def test_init_client(mock_httpx_client):
+    await init_client()
+    mock_httpx_client.assert_called_once()
+    assert get_client() is mock_httpx_client.return_value
+
+    limits = mock_httpx_client.call_args.kwargs["limits"]
+    assert limits.max_keepalive_connections == 50
+    assert limits.max_connections == 100
+
+
+@pytest.mark.asyncio
+async def test_close_client(mock_httpx_client):
+    await init_client()
+    await close_client()
+    mock_httpx_client.return_value.aclose.assert_called_once()
@@ -0,0 +1,50 @@
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from example_agents_project.slack import (
+    prebuild_message,
+    send_slack_message,
+    SLACK_URL,
+)
+
+
+@pytest.fixture
+def mock_post():
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+
+    with patch("example_agents_project.slack.http.get_client") as mock_get_client:
+        mock_get_client.return_value.post = AsyncMock(return_value=mock_response)
+        yield mock_get_client.return_value.post
+
+
+def _sent_payload(mock_post):
+    assert mock_post.call_args.args == (SLACK_URL,)
+    return json.loads(mock_post.call_args.kwargs["content"])
+
+
+@pytest.mark.asyncio
+async def test_send_slack_message(mock_post):
+    """Test sending a message in a thread."""
+    await send_slack_message("Hi *there*", "C123", "123.456")
+
+    assert _sent_payload(mock_post) == {
+        "channel": "C123",
+        "thread_ts": "123.456",
+        "blocks": [
+            {"type": "section", "text": {"type": "mrkdwn", "text": "Hi *there*"}}
+        ],
+    }
+
+
+@pytest.mark.asyncio
+async def test_send_prebuilt_slack_message(mock_post):
+    """Test a prebuilt message produces the same payload without a thread."""
+    message = prebuild_message('Canned "reply"\nwith newline')
+
+    await send_slack_message(message, "C123")
+
+    payload = _sent_payload(mock_post)
+    assert "thread_ts" not in payload
+    assert payload["channel"] == "C123"
+    assert payload["blocks"][0]["text"]["text"] == message